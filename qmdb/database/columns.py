@@ -0,0 +1,142 @@
+import numpy as np
+from arrow import Arrow
+
+
+def get_dtype(column_type):
+    if column_type.startswith('float'):
+        return np.dtype('float64')
+    if column_type.startswith('datetime') or column_type.startswith('timestamp'):
+        return np.dtype('datetime64[us]')
+    if 'int' in column_type:
+        return np.dtype('int64')
+    return np.dtype('object')
+
+
+def get_null_value(dtype):
+    if dtype == np.dtype('datetime64[us]'):
+        return np.datetime64('NaT')
+    if dtype == np.dtype('object'):
+        return None
+    return 0
+
+
+def to_array_value(value, dtype):
+    if isinstance(value, Arrow):
+        return np.datetime64(value.to('UTC').naive, 'us')
+    if dtype == np.dtype('int64'):
+        return int(value)
+    return value
+
+
+class MovieColumns:
+    def __init__(self, column_types):
+        """
+        A column-oriented copy of the scalar attributes of the movies, with one typed array per attribute.
+        Each movie has a fixed row in all of the arrays, and a null mask per attribute tells which values are missing.
+        Datetimes are stored in UTC.
+        :param column_types: a dictionary with the database column type of each attribute
+        """
+        self.dtypes = {column: get_dtype(column_type) for column, column_type in column_types.items()}
+        self.size = 0
+        self.rows = {}
+        self.crit_id_array = np.zeros(0, dtype=np.int64)
+        self.data = {column: np.zeros(0, dtype=dtype) for column, dtype in self.dtypes.items()}
+        self.null_masks = {column: np.zeros(0, dtype=bool) for column in self.dtypes}
+
+    def build(self, movies):
+        movies = list(movies)
+        self.size = len(movies)
+        self.rows = {movie.crit_id: row for row, movie in enumerate(movies)}
+        self.crit_id_array = np.array([movie.crit_id for movie in movies], dtype=np.int64)
+        for column, dtype in self.dtypes.items():
+            values = [getattr(movie, column, None) for movie in movies]
+            null_value = get_null_value(dtype)
+            self.null_masks[column] = np.array([value is None for value in values], dtype=bool)
+            self.data[column] = np.array([null_value if value is None else to_array_value(value, dtype)
+                                          for value in values], dtype=dtype)
+
+    def update(self, movie):
+        row = self.rows.get(movie.crit_id)
+        if row is None:
+            row = self.append(movie.crit_id)
+        for column, dtype in self.dtypes.items():
+            value = getattr(movie, column, None)
+            self.null_masks[column][row] = value is None
+            self.data[column][row] = get_null_value(dtype) if value is None else to_array_value(value, dtype)
+
+    def append(self, crit_id):
+        if self.size == len(self.crit_id_array):
+            self.grow(max(16, 2 * self.size))
+        row = self.size
+        self.crit_id_array[row] = crit_id
+        self.rows[crit_id] = row
+        self.size += 1
+        return row
+
+    def remove(self, crit_id):
+        """
+        Removes the row of a movie by moving the last row into its place
+        """
+        row = self.rows.pop(crit_id, None)
+        if row is None:
+            return
+        last = self.size - 1
+        if row != last:
+            moved_crit_id = int(self.crit_id_array[last])
+            self.crit_id_array[row] = moved_crit_id
+            for column in self.dtypes:
+                self.data[column][row] = self.data[column][last]
+                self.null_masks[column][row] = self.null_masks[column][last]
+            self.rows[moved_crit_id] = row
+        self.size -= 1
+
+    def grow(self, capacity):
+        def resized(array, fill_value):
+            new_array = np.full(capacity, fill_value, dtype=array.dtype)
+            new_array[:self.size] = array[:self.size]
+            return new_array
+        self.crit_id_array = resized(self.crit_id_array, 0)
+        for column, dtype in self.dtypes.items():
+            self.data[column] = resized(self.data[column], get_null_value(dtype))
+            self.null_masks[column] = resized(self.null_masks[column], True)
+
+    @property
+    def crit_ids(self):
+        return self.crit_id_array[:self.size]
+
+    def nulls(self, column):
+        return self.null_masks[column][:self.size]
+
+    def column(self, column, fill=None):
+        """
+        :param column: the name of the attribute
+        :param fill: a value to put in place of the missing values. Use np.nan to get integers as floats.
+        :return: an array with a value for each row. Without a fill value, the array is a read-only view
+                 and the values of the missing rows are meaningless.
+        """
+        data = self.data[column][:self.size]
+        if fill is not None:
+            return np.where(self.nulls(column), fill, data)
+        data = data.view()
+        data.flags.writeable = False
+        return data
+
+    def values(self, column):
+        """
+        :return: an array with the values that aren't missing
+        """
+        return self.data[column][:self.size][~self.nulls(column)]
+
+    def floating_release_years(self):
+        """
+        The vectorised counterpart of Movie.get_floating_release_year
+        """
+        years = np.where(self.nulls('imdb_year'), self.column('year', fill=np.nan),
+                         self.column('imdb_year', fill=np.nan)) + 0.5
+        release_dates = self.column('original_release_date')
+        release_years = release_dates.astype('datetime64[Y]')
+        year_start = release_years.astype('datetime64[us]')
+        year_end = (release_years + 1).astype('datetime64[us]')
+        fractions = (release_dates - year_start) / (year_end - year_start)
+        return np.where(self.nulls('original_release_date'),
+                        years, release_years.astype(np.int64) + 1970 + fractions)
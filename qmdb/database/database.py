@@ -1,86 +1,53 @@
 import copy
+from bisect import bisect_left
+import heapq
+import os
+import pickle
+import threading
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from itertools import groupby
+from operator import itemgetter
 
 import arrow
+import numpy as np
 import pymysql.cursors
 from arrow import Arrow
 
 from qmdb.config import config
-from qmdb.movie.movie import Movie
+from qmdb.database.columns import MovieColumns
+from qmdb.database.indexes import AttributeIndex, InvertedIndex, SortedIndex, intersect_sorted
+from qmdb.database.pool import ConnectionPool
+from qmdb.database.query import make_getter
+from qmdb.movie.movie import Movie, ATTRIBUTES, LAZY_ATTRIBUTES
+from qmdb.movie.persons import intern_string, person_registry
+
+SNAPSHOT_VERSION = 5
 
 
 class Database:
-    def __init__(self, from_scratch=False):
+    def __init__(self, from_scratch=False, sync_mode='diff', load_threads=1, snapshot_path=None, load_profile='full',
+                 lazy_batch_size=1000):
+        if sync_mode not in ('diff', 'replace'):
+            raise Exception("The sync mode should be either 'diff' or 'replace'")
+        if load_profile not in ('full', 'core'):
+            raise Exception("The load profile should be either 'full' or 'core'")
+        self.sync_mode = sync_mode
+        # With the 'core' profile, the lazy attributes of the movies are only loaded when they are first accessed
+        self.load_profile = load_profile
+        self.lazy_batch_size = lazy_batch_size
+        self.pending_crit_ids = {attribute: [] for attribute in LAZY_ATTRIBUTES}
+        self.load_threads = load_threads
+        self.snapshot_path = snapshot_path
+        self.last_loaded = None
         self.movies = {}
         self.conn = None
         self.c = None
-        self.load_or_initialize(from_scratch=from_scratch)
-
-    def load_or_initialize(self, from_scratch=False):
-        if from_scratch:
-            self.initialize()
-        else:
-            self.load()
-
-    def connect(self, from_scratch=False):
-        raise NotImplementedError
-
-    def close(self):
-        self.conn.commit()
-        self.conn.close()
-
-    def initialize(self):
-        raise NotImplementedError
-
-    def load(self):
-        raise NotImplementedError
-
-    def get_movie(self, crit_id):
-        try:
-            return self.movies[crit_id]
-        except KeyError as e:
-            print("CritickerID {} does not exist in the database.".format(e.args[0]))
-            raise MovieNotInDatabaseError(crit_id=crit_id)
-
-    def print(self):
-        movies = sorted(list(self.movies.values()),
-                        key=lambda x: max(arrow.get('1970-01-01') if x.criticker_updated is None else x.criticker_updated,
-                                          arrow.get('1970-01-01') if x.omdb_updated is None else x.omdb_updated),
-                        reverse=True)
-        for movie in movies[:10]:
-            self.movies[movie.crit_id].print()
-        print("\n")
-
-    @staticmethod
-    def make_dict_db_safe(d):
-        d = copy.deepcopy(d)
-        for k in d:
-            if isinstance(d[k], Arrow):
-                d[k] = d[k].format()
-            if isinstance(d[k], list):
-                d[k] = [e.format() if isinstance(e, Arrow) else e for e in d[k]]
-        return d
-
-
-def max_date(l):
-    if len(l) > 0:
-        m = max([e for e in l if e is not None], default=None)
-        if m is not None:
-            return arrow.get(m)
-        else:
-            return None
-    else:
-        return None
-
-
-class MySQLDatabase(Database):
-    def __init__(self, from_scratch=False, schema='qmdb', env='prd'):
-        if env == 'prd':
-            self.config = config.mysql_prd
-        else:
-            self.config = config.mysql_tst
-        self.schema = schema
+        self.connection_depth = 0
+        # Serialises the writes and lazy loads of threads that share this database, such as the update workers
+        self.lock = threading.RLock()
         self.columns_movies = {
             'crit_id': 'mediumint unsigned not null',
             'imdbid': 'int unsigned',
@@ -99,8 +66,8 @@ class MySQLDatabase(Database):
             'runtime': 'smallint unsigned',
             'plot_summary': 'varchar(4096)',
             'plot_storyline': 'varchar(8192)',
-            'original_release_date': 'varchar(32)',
-            'dutch_release_date': 'varchar(32)',
+            'original_release_date': 'datetime',
+            'dutch_release_date': 'datetime',
             'crit_popularity': 'float',
             'crit_url': 'varchar(256) not null',
             'tomato_url': 'varchar(256)',
@@ -111,19 +78,20 @@ class MySQLDatabase(Database):
             'netflix_id': 'int unsigned',
             'netflix_title': 'varchar(256)',
             'netflix_rating': 'float',
-            'date_added': 'varchar(32) not null',
-            'criticker_updated': 'varchar(32)',
-            'imdb_main_updated': 'varchar(32)',
-            'imdb_release_updated': 'varchar(32)',
-            'imdb_metacritic_updated': 'varchar(32)',
-            'imdb_keywords_updated': 'varchar(32)',
-            'imdb_taglines_updated': 'varchar(32)',
-            'imdb_vote_details_updated': 'varchar(32)',
-            'imdb_plot_updated': 'varchar(32)',
-            'omdb_updated': 'varchar(32)',
-            'ptp_updated': 'varchar(32)',
-            'unogs_updated': 'varchar(32)',
-            'netflix_updated': 'varchar(32)'
+            'date_added': 'datetime(6) not null',
+            'criticker_updated': 'datetime(6)',
+            'imdb_main_updated': 'datetime(6)',
+            'imdb_release_updated': 'datetime(6)',
+            'imdb_metacritic_updated': 'datetime(6)',
+            'imdb_keywords_updated': 'datetime(6)',
+            'imdb_taglines_updated': 'datetime(6)',
+            'imdb_vote_details_updated': 'datetime(6)',
+            'imdb_plot_updated': 'datetime(6)',
+            'omdb_updated': 'datetime(6)',
+            'ptp_updated': 'datetime(6)',
+            'unogs_updated': 'datetime(6)',
+            'netflix_updated': 'datetime(6)',
+            'last_modified': 'timestamp(6) not null default current_timestamp(6) on update current_timestamp(6)'
         }
         self.columns_persons = {
             'crit_id': 'mediumint unsigned not null',
@@ -171,133 +139,632 @@ class MySQLDatabase(Database):
         self.columns_netflix_genres = {
             'genreid': 'int unsigned not null',
             'genre_name': 'varchar(128)',
-            'movies_updated': 'varchar(32)'
+            'movies_updated': 'datetime(6)'
         }
-        self.columns_unogs_suspension = {
+        self.columns_schema_version = {
             'id': 'tinyint unsigned not null',
-            'last_suspension': 'varchar(32)'
+            'version': 'smallint unsigned not null'
         }
+        self.columns_schedule = {
+            'crit_id': 'mediumint unsigned not null',
+            'source': 'varchar(32) not null',
+            'next_update': 'datetime(6) not null',
+            'period': 'float'
+        }
+        self.columns_rate_limits = {
+            'host': 'varchar(128) not null',
+            'tokens': 'float',
+            'updated': 'datetime(6)',
+            'suspended_until': 'datetime(6)'
+        }
+        self.primary_keys = {'movies': ['crit_id'],
+                             'persons': ['crit_id', 'person_id', 'role'],
+                             'genres': ['crit_id', 'genre'],
+                             'countries': ['crit_id', 'country'],
+                             'languages': ['crit_id', 'language'],
+                             'keywords': ['crit_id', 'keyword'],
+                             'taglines': ['crit_id', 'rank'],
+                             'vote_details': ['crit_id', 'demographic'],
+                             'ratings': ['crit_id', 'user', 'type'],
+                             'netflix_genres': ['genreid', 'genre_name'],
+                             'schema_version': ['id'],
+                             'schedule': ['crit_id', 'source'],
+                             'rate_limits': ['host']}
+        # Secondary indexes, each a list of columns, for the ways the tables are searched besides the primary key
+        self.indexes = {'movies': [['imdbid'], ['netflix_id'], ['last_modified']],
+                        'persons': [['person_id'], ['role']],
+                        'genres': [['genre']],
+                        'countries': [['country']],
+                        'languages': [['language']],
+                        'keywords': [['keyword']],
+                        'taglines': [['rank']],
+                        'vote_details': [['demographic']],
+                        'ratings': [['user', 'type', 'score']],
+                        'netflix_genres': [['movies_updated']],
+                        'schema_version': [],
+                        'schedule': [['next_update']],
+                        'rate_limits': []}
+        self.child_tables = {'persons': ['cast', 'director', 'writer'],
+                             'genres': ['genres'],
+                             'countries': ['countries'],
+                             'languages': ['languages'],
+                             'keywords': ['keywords'],
+                             'taglines': ['taglines'],
+                             'ratings': ['my_ratings'],
+                             'vote_details': ['vote_details']}
         self.netflix_genres = None
-        self.unogs_suspension = None
-        self.imdbid_to_critid = {}
-        super().__init__(from_scratch=from_scratch)
-        self.create_imdbid_to_crit_id_dict()
+        self.attribute_indexes = {attribute: AttributeIndex(attribute)
+                                  for attribute in ['imdbid', 'netflix_id', 'crit_url']}
+        self.inverted_indexes = {attribute: InvertedIndex(attribute)
+                                 for attribute in ['genres', 'countries', 'languages', 'keywords']
+                                 if self.is_loaded_up_front(attribute)}
+        # The indexes of lazy attributes are only built the first time they are used
+        self.deferred_indexes = [attribute for attribute in ['keywords'] if not self.is_loaded_up_front(attribute)]
+        self.inverted_indexes.update({attribute: InvertedIndex(attribute, key='person_id')
+                                      for attribute in ['cast', 'director', 'writer']})
+        self.sorted_indexes = {attribute: SortedIndex(attribute)
+                               for attribute in ['year', 'imdb_rating', 'imdb_votes', 'crit_rating', 'crit_popularity',
+                                                 'runtime']}
+        self.column_store = MovieColumns({k: v for k, v in self.columns_movies.items()
+                                          if k != 'last_modified' and self.is_loaded_up_front(k)})
+        # The schema version of a database is the number of these steps it has had, so new steps go at the end
+        self.migrations = [self.add_all_missing_columns, self.update_secondary_indexes, self.create_schedule_table,
+                           self.create_rate_limits_table, self.create_last_modified_index]
+        self.load_or_initialize(from_scratch=from_scratch)
+        self.build_indexes()
 
     def load_or_initialize(self, from_scratch=False):
         if from_scratch:
-            self.connect()
-            self.initialize()
-            self.close()
+            with self.connection():
+                self.initialize()
         else:
-            try:
-                self.load()
-            except pymysql.err.ProgrammingError:
-                print("Something went wrong trying to load the tables.")
-                raise Exception
+            self.load()
 
     def connect(self, from_scratch=False):
-        self.conn = pymysql.connect(host=self.config['host'],
-                                    user=self.config['username'],
-                                    password=self.config['password'],
-                                    db=self.schema,
-                                    charset='utf8mb4',
-                                    use_unicode=True,
-                                    cursorclass=pymysql.cursors.DictCursor)
-        self.c = self.conn.cursor()
+        if self.conn is None:
+            self.conn = self.get_connection()
+            self.c = self.new_cursor(self.conn)
+        self.connection_depth += 1
+
+    @contextmanager
+    def connection(self):
+        """
+        Opens a connection, or joins the one that is open already, for the duration of a with block.
+        The outermost block commits at its end. An error anywhere inside rolls back the whole transaction
+        and gives up the connection, which may be broken, so that it isn't kept for the next block.
+        """
+        self.connect()
+        try:
+            yield
+        except BaseException:
+            self.abort()
+            raise
+        self.close()
+
+    def abort(self):
+        """
+        Rolls back the current transaction and discards its connection, however deeply it was opened
+        """
+        conn = self.conn
+        self.conn = None
+        self.c = None
+        self.connection_depth = 0
+        if conn is not None:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            self.discard_connection(conn)
+
+    def close(self):
+        self.connection_depth = max(self.connection_depth - 1, 0)
+        if self.conn is None:
+            return
+        try:
+            self.conn.commit()
+        except Exception:
+            if self.connection_depth == 0:
+                self.discard_connection(self.conn)
+                self.conn = None
+                self.c = None
+            raise
+        if self.connection_depth == 0:
+            self.c.close()
+            self.release_connection(self.conn)
+            self.conn = None
+            self.c = None
+
+    def get_connection(self):
+        raise NotImplementedError
+
+    def release_connection(self, conn):
+        raise NotImplementedError
+
+    def discard_connection(self, conn):
+        raise NotImplementedError
+
+    def new_cursor(self, conn, streaming=False):
+        return conn.cursor()
+
+    def disconnect(self):
+        raise NotImplementedError
 
     def create_table(self, table_name, column_info, primary_keys, indexes):
+        raise NotImplementedError
+
+    @staticmethod
+    def check_table_definition(primary_keys, indexes):
         if not isinstance(primary_keys, list) or len(primary_keys) == 0 or not isinstance(primary_keys[0], str):
             raise Exception("Something is wrong with the primary keys")
-        if not isinstance(indexes, list) or len(indexes) == 0 or not isinstance(indexes[0], str):
+        if not isinstance(indexes, list) or not all([isinstance(e, list) and len(e) > 0 for e in indexes]):
             raise Exception("Something is wrong with the indexes")
-        self.c.execute("drop table if exists {}".format(table_name))
-        print("Creating table {}.{}".format(self.schema, table_name))
-        with self.conn:
-            sql = """
-                CREATE TABLE {} (
-                    {},
-                    PRIMARY KEY({}), INDEX({})
-                ) DEFAULT CHARSET=utf8mb4
-                """.format(table_name,
-                           ', '.join(["{} {}".format(k, v) for k, v in column_info.items()]),
-                           ', '.join(primary_keys),
-                           '), INDEX('.join(indexes))
-            self.c.execute(sql)
+
+    @staticmethod
+    def get_index_name(table_name, columns):
+        return '{}_{}'.format(table_name, '_'.join(columns))
+
+    def create_index(self, table_name, columns):
+        self.c.execute("create index {} on {} ({})".format(
+            self.get_index_name(table_name, columns), table_name, ', '.join(columns)))
+
+    def drop_index(self, table_name, index_name):
+        raise NotImplementedError
+
+    def get_table_indexes(self, table_name):
+        """
+        :return: a dictionary with the columns of each secondary index of the table
+        """
+        raise NotImplementedError
 
     def initialize(self, tbls=None):
         if tbls is None:
-            tbls = ['movies', 'persons', 'genres', 'countries', 'languages',
-                    'keywords', 'taglines', 'vote_details', 'ratings',
-                    'netflix_genres', 'unogs_suspension']
-        if 'movies' in tbls:
-            self.create_table('movies', self.columns_movies, ['crit_id'], ['crit_id'])
-        if 'persons' in tbls:
-            self.create_table('persons', self.columns_persons, ['crit_id', 'person_id', 'role'], ['person_id', 'role'])
-        if 'genres' in tbls:
-            self.create_table('genres', self.columns_genres, ['crit_id', 'genre'], ['genre'])
-        if 'countries' in tbls:
-            self.create_table('countries', self.columns_countries, ['crit_id', 'country'], ['country'])
-        if 'languages' in tbls:
-            self.create_table('languages', self.columns_languages, ['crit_id', 'language'], ['language'])
-        if 'keywords' in tbls:
-            self.create_table('keywords', self.columns_keywords, ['crit_id', 'keyword'], ['keyword'])
-        if 'taglines' in tbls:
-            self.create_table('taglines', self.columns_taglines, ['crit_id', 'rank'], ['rank'])
-        if 'vote_details' in tbls:
-            self.create_table('vote_details', self.columns_vote_details, ['crit_id', 'demographic'], ['demographic'])
-        if 'ratings' in tbls:
-            self.create_table('ratings', self.columns_ratings, ['crit_id', 'user', 'type'], ['user', 'type'])
-        if 'netflix_genres' in tbls:
-            self.create_table('netflix_genres', self.columns_netflix_genres, ['genreid', 'genre_name'], ['movies_updated'])
-        if 'unogs_suspension' in tbls:
-            self.create_table('unogs_suspension', self.columns_unogs_suspension, ['id'], ['last_suspension'])
+            tbls = list(self.primary_keys.keys())
+        for tbl in tbls:
+            self.create_table(tbl, getattr(self, 'columns_' + tbl), self.primary_keys[tbl], self.indexes[tbl])
+        if 'schema_version' in tbls:
+            self.set_schema_version(len(self.migrations))
+
+    def get_schema_version(self):
+        if len(self.get_table_columns('schema_version')) == 0:
+            return 0
+        self.c.execute("select version from schema_version where id = 1")
+        row = self.c.fetchone()
+        return 0 if row is None else row['version']
+
+    def set_schema_version(self, version):
+        self.upsert_records('schema_version', [{'id': 1, 'version': version}])
+
+    def migrate(self):
+        """
+        Brings the schema up to date by running the migration steps it hasn't had yet, in order.
+        When the schema is already up to date, this is just a version check.
+        """
+        version = self.get_schema_version()
+        for new_version, migration in enumerate(self.migrations[version:], start=version + 1):
+            print("Migrating the schema to version {}".format(new_version))
+            migration()
+            self.set_schema_version(new_version)
+            self.conn.commit()
+
+    def add_all_missing_columns(self):
+        """
+        Migration 1: creates the missing tables and columns and converts date strings to datetime columns,
+        which is what every load used to do before the schema was versioned
+        """
+        for tbl in self.primary_keys:
+            self.add_missing_columns(tbl)
+
+    def update_secondary_indexes(self):
+        """
+        Migration 2: creates the declared secondary indexes and drops the ones that aren't declared anymore,
+        such as the index on movies.crit_id, which duplicated the primary key
+        """
+        for tbl, indexes in self.indexes.items():
+            actual_indexes = self.get_table_indexes(tbl)
+            for index_name, columns in actual_indexes.items():
+                if columns not in indexes:
+                    print("Dropping index {} of table {}".format(index_name, tbl))
+                    self.drop_index(tbl, index_name)
+            for columns in indexes:
+                if columns not in actual_indexes.values():
+                    print("Creating index on {}({})".format(tbl, ', '.join(columns)))
+                    self.create_index(tbl, columns)
+
+    def create_schedule_table(self):
+        """
+        Migration 3: creates the table with the update schedule of the Updater
+        """
+        if len(self.get_table_columns('schedule')) == 0:
+            self.initialize(tbls=['schedule'])
+
+    def create_rate_limits_table(self):
+        """
+        Migration 4: creates the table with the token buckets of the rate limiter, which takes over the
+        suspension of uNoGS from the unogs_suspension table
+        """
+        if len(self.get_table_columns('rate_limits')) == 0:
+            self.initialize(tbls=['rate_limits'])
+        if len(self.get_table_columns('unogs_suspension')) > 0:
+            rows = self.load_table('unogs_suspension')
+            if len(rows) > 0 and rows[0]['last_suspension'] is not None:
+                last_suspension = arrow.get(rows[0]['last_suspension'])
+                self.upsert_records('rate_limits', [{'host': 'unogs-unogs-v1.p.mashape.com', 'tokens': 0,
+                                                     'updated': arrow_to_db(last_suspension),
+                                                     'suspended_until': arrow_to_db(last_suspension.shift(hours=18))}])
+            self.c.execute("drop table unogs_suspension")
+
+    def create_last_modified_index(self):
+        """
+        Migration 5: indexes movies.last_modified, on which a refresh selects the modified movies and their child rows
+        """
+        if ['last_modified'] not in self.get_table_indexes('movies').values():
+            self.create_index('movies', ['last_modified'])
 
     def load(self, verbose=False):
-        self.connect()
-        movies = self.load_movies()
-        self.load_persons(movies)
-        self.load_genres(movies)
-        self.load_countries(movies)
-        self.load_languages(movies)
-        self.load_keywords(movies)
-        self.load_taglines(movies)
-        self.load_vote_details(movies)
-        self.load_ratings(movies)
-        self.everything_to_movie(movies)
-        self.load_netflix_genres()
-        self.load_unogs_suspension()
-        self.close()
+        with self.connection():
+            self.migrate()
+            fingerprint = None
+            snapshot = None
+            if self.snapshot_path is not None:
+                fingerprint = self.get_fingerprint()
+                snapshot = self.read_snapshot()
+            if snapshot is not None:
+                print("Loading movies from snapshot...")
+                self.movies = snapshot['movies']
+                self.netflix_genres = snapshot['netflix_genres']
+                self.last_loaded = snapshot['last_loaded']
+                self.track_lazy_attributes()
+                if fingerprint is None or fingerprint != snapshot['fingerprint']:
+                    self.refresh()
+                    self.save_snapshot(fingerprint)
+            else:
+                self.last_loaded = self.get_server_time()
+                child_loaders = self.get_child_loaders()
+                if self.load_threads > 1:
+                    movies = self.load_in_parallel(child_loaders)
+                else:
+                    movies = self.load_movies()
+                    for loader in child_loaders:
+                        loader(movies)
+                self.everything_to_movie(movies)
+                if self.load_profile == 'core':
+                    for movie in self.movies.values():
+                        movie.unload(LAZY_ATTRIBUTES, self.load_lazy_attribute)
+                    self.track_lazy_attributes()
+                self.load_netflix_genres()
+        if snapshot is not None:
+            if verbose:
+                print("database loaded from snapshot.")
+            return
+        if self.snapshot_path is not None:
+            self.save_snapshot(fingerprint)
         if verbose:
             print("database loaded.")
 
-    def create_imdbid_to_crit_id_dict(self):
-        self.imdbid_to_critid = {}
-        for crit_id in self.movies:
-            movie = self.movies[crit_id]
-            if movie.imdbid is not None:
-                crit_id = self.imdbid_to_critid.get(movie.imdbid)
-                if isinstance(crit_id, int):
-                    crit_id = {crit_id, movie.crit_id}
-                elif isinstance(crit_id, set):
-                    crit_id.add(movie.crit_id)
+    def refresh(self, verbose=False):
+        """
+        Fetches the movies that were modified since the last load or refresh, including their child rows,
+        and applies them in place to the existing Movie objects. Changes that were made in memory but weren't
+        saved yet win over the ones in the database, and movies that were deleted from the database are dropped.
+        """
+        with self.lock:
+            with self.connection():
+                modified_since = self.last_loaded
+                self.last_loaded = self.get_server_time()
+                movies = self.load_movies(modified_since=modified_since)
+                if len(movies) > 0:
+                    for loader in self.get_child_loaders():
+                        loader(movies, modified_since=modified_since)
+                self.load_netflix_genres()
+                stored_crit_ids = {row['crit_id'] for row in self.stream_table('movies', ['crit_id'],
+                                                                               columns=['crit_id'])}
+            for crit_id, movie_info in movies.items():
+                if crit_id in self.movies:
+                    movie = self.movies[crit_id]
+                    pending = {attribute: getattr(movie, attribute) for attribute in movie.changed_attributes}
+                    # Child rows that were removed should not survive the refresh
+                    for attributes in self.child_tables.values():
+                        for attribute in attributes:
+                            setattr(movie, attribute, dict() if attribute == 'my_ratings' else None)
+                    movie.update_from_dict(movie_info)
+                    for attribute, value in pending.items():
+                        setattr(movie, attribute, value)
+                    movie.changed_attributes = set(pending)
                 else:
-                    crit_id = movie.crit_id
-                if isinstance(crit_id, set) and len(crit_id) == 1:
-                    crit_id = crit_id[0]
-                self.imdbid_to_critid[movie.imdbid] = crit_id
+                    movie = Movie.from_records([movie_info])[0]
+                    self.movies[crit_id] = movie
+                if self.load_profile == 'core':
+                    self.unload_lazy_attributes(movie)
+                self.update_indexes(movie)
+            deleted_crit_ids = [crit_id for crit_id, movie in self.movies.items()
+                                if crit_id not in stored_crit_ids and len(movie.changed_attributes) == 0]
+            for crit_id in deleted_crit_ids:
+                self.remove_movie(crit_id)
+        if verbose:
+            print("{} movies refreshed, {} removed.".format(len(movies), len(deleted_crit_ids)))
+        return list(movies.keys())
 
-    def load_table(self, tbl):
+    def remove_movie(self, crit_id):
+        """
+        Forgets a movie in memory, e.g. after it was deleted from the database
+        """
+        del self.movies[crit_id]
+        for index in self.get_indexes():
+            index.remove(crit_id)
+        self.column_store.remove(crit_id)
+        for pending in self.pending_crit_ids.values():
+            i = bisect_left(pending, crit_id)
+            if i < len(pending) and pending[i] == crit_id:
+                del pending[i]
+
+    def is_loaded_up_front(self, attribute):
+        return self.load_profile == 'full' or attribute not in LAZY_ATTRIBUTES
+
+    def get_child_loaders(self):
+        return [loader for attribute, loader in [('persons', self.load_persons), ('genres', self.load_genres),
+                                                 ('countries', self.load_countries),
+                                                 ('languages', self.load_languages),
+                                                 ('keywords', self.load_keywords), ('taglines', self.load_taglines),
+                                                 ('vote_details', self.load_vote_details),
+                                                 ('ratings', self.load_ratings)]
+                if self.is_loaded_up_front(attribute)]
+
+    def unload_lazy_attributes(self, movie):
+        movie.unload(LAZY_ATTRIBUTES, self.load_lazy_attribute)
+        for attribute in LAZY_ATTRIBUTES:
+            pending = self.pending_crit_ids[attribute]
+            i = bisect_left(pending, movie.crit_id)
+            if i == len(pending) or pending[i] != movie.crit_id:
+                pending.insert(i, movie.crit_id)
+
+    def track_lazy_attributes(self):
+        """
+        Finds the movies of which lazy attributes still need to be loaded, e.g. after reading a snapshot,
+        and makes sure these movies can load them
+        """
+        self.pending_crit_ids = {attribute: [] for attribute in LAZY_ATTRIBUTES}
+        for crit_id, movie in sorted(self.movies.items()):
+            for attribute in LAZY_ATTRIBUTES:
+                if not movie.is_loaded(attribute):
+                    self.pending_crit_ids[attribute].append(crit_id)
+                    movie.loader = self.load_lazy_attribute
+
+    def load_lazy_attribute(self, attribute, crit_id):
+        """
+        Loads a lazy attribute of a movie, together with the same attribute of the next movies that still need it,
+        so that going through many movies only takes a query per batch
+        :param attribute: one of the lazy attributes, such as 'plot_summary' or 'keywords'
+        :param crit_id: the criticker id of the movie that needs it
+        """
+        with self.lock:
+            pending = self.pending_crit_ids[attribute]
+            i = bisect_left(pending, crit_id)
+            crit_ids = pending[i:i + self.lazy_batch_size]
+            del pending[i:i + self.lazy_batch_size]
+            if len(crit_ids) == 0 or crit_ids[0] != crit_id:
+                crit_ids.insert(0, crit_id)
+            movies = {crit_id: {} for crit_id in crit_ids}
+            with self.connection():
+                if attribute in self.columns_movies:
+                    for row in self.stream_table('movies', ['crit_id'], columns=['crit_id', attribute],
+                                                 crit_ids=crit_ids):
+                        movies[row['crit_id']][attribute] = row[attribute]
+                else:
+                    getattr(self, 'load_' + attribute)(movies, crit_ids=crit_ids)
+            for crit_id, movie_info in movies.items():
+                movie = self.movies.get(crit_id)
+                # A value that was set in the meantime is newer than the one in the database
+                if movie is not None and not movie.is_loaded(attribute):
+                    setattr(movie, attribute, movie_info.get(attribute))
+
+    def get_server_time(self):
+        self.c.execute("select {} as now".format(self.now_sql))
+        return self.c.fetchone()['now']
+
+    def get_fingerprint(self):
+        return None
+
+    def get_snapshot_tables(self):
+        # The schedule and rate limits aren't kept in memory, and change far too often for snapshots to keep up
+        return [tbl for tbl in self.primary_keys if tbl not in ('schedule', 'rate_limits')]
+
+    def get_snapshot_columns(self):
+        return {tbl: getattr(self, 'columns_' + tbl) for tbl in self.get_snapshot_tables()}
+
+    def read_snapshot(self):
+        if not os.path.isfile(self.snapshot_path):
+            return None
         try:
-            self.add_missing_columns(tbl)
-            self.c.execute("select * from {}".format(tbl))
-        except pymysql.err.ProgrammingError:
-            print("The {} table does not exist!".format(tbl))
-            raise
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            print("Could not read the snapshot {}: {}".format(self.snapshot_path, e))
+            return None
+        if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('schema') != self.schema \
+                or snapshot.get('columns') != self.get_snapshot_columns() \
+                or snapshot.get('load_profile') != self.load_profile:
+            print("The snapshot doesn't match this database.")
+            return None
+        return snapshot
+
+    def save_snapshot(self, fingerprint=None):
+        """
+        Stores the in-memory state in a local file, so that the next load only needs to fetch what changed
+        :param fingerprint: the fingerprint of the tables the state corresponds to, if it is known.
+                            Without it, the next load always refreshes the snapshot.
+        """
+        snapshot = {'version': SNAPSHOT_VERSION,
+                    'schema': self.schema,
+                    'columns': self.get_snapshot_columns(),
+                    'load_profile': self.load_profile,
+                    'fingerprint': fingerprint,
+                    'last_loaded': self.last_loaded,
+                    'movies': self.movies,
+                    'netflix_genres': self.netflix_genres}
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def load_in_parallel(self, child_loaders):
+        raise NotImplementedError
+
+    def get_indexes(self):
+        return list(self.attribute_indexes.values()) + list(self.inverted_indexes.values()) \
+            + list(self.sorted_indexes.values())
+
+    def build_indexes(self):
+        for attribute in self.deferred_indexes:
+            self.inverted_indexes.pop(attribute, None)
+        for index in self.get_indexes():
+            index.build(self.movies.values())
+        self.column_store.build(self.movies.values())
+
+    def update_indexes(self, movie):
+        for index in self.get_indexes():
+            index.update(movie)
+        self.column_store.update(movie)
+
+    def get_inverted_index(self, attribute):
+        """
+        Returns the inverted index of an attribute. For a lazy attribute with the 'core' profile, the index is built
+        from its table on first use, without loading the attribute itself into the movies.
+        """
+        if attribute in self.deferred_indexes and attribute not in self.inverted_indexes:
+            with self.lock:
+                if attribute not in self.inverted_indexes:
+                    movies = {crit_id: {} for crit_id in self.movies}
+                    with self.connection():
+                        getattr(self, 'load_' + attribute)(movies)
+                    for crit_id, movie_info in movies.items():
+                        # A value that was loaded or set in memory is newer than the one in the database
+                        if self.movies[crit_id].is_loaded(attribute):
+                            movie_info[attribute] = getattr(self.movies[crit_id], attribute)
+                    index = InvertedIndex(attribute)
+                    index.build_from_values((crit_id, movie_info.get(attribute) or [])
+                                            for crit_id, movie_info in movies.items())
+                    self.inverted_indexes[attribute] = index
+        return self.inverted_indexes[attribute]
+
+    def get_crit_ids(self, attribute, value):
+        """
+        Looks up movies by an indexed attribute, such as 'imdbid', 'netflix_id' or 'crit_url'
+        :return: a set of criticker ids
+        """
+        return self.attribute_indexes[attribute].get(value)
+
+    def find_movies(self, **criteria):
+        """
+        Finds the movies that have all the given values, using the inverted indexes,
+        e.g. find_movies(languages='Dutch', genres=['Thriller', 'Drama'], director=1234)
+        :param criteria: a value or a list of values per indexed attribute. Persons are given by their person id.
+        :return: a sorted list of criticker ids
+        """
+        lists = []
+        for attribute, values in criteria.items():
+            if not isinstance(values, list):
+                values = [values]
+            lists += [self.get_inverted_index(attribute).crit_ids.get(value, []) for value in values]
+        return intersect_sorted(lists)
+
+    def query(self, order_by=None, k=None, ascending=False, where=None, **filters):
+        """
+        Selects movies from memory, using the indexes where possible, and ranks them,
+        e.g. query(year=(2001, None), where=lambda m: m.netflix_id is not None,
+                   order_by="my_ratings['tijl']['pred_score']", k=10)
+        :param order_by: an attribute or a path into it such as "my_ratings['tijl']['pred_score']".
+                         Movies without a value are left out.
+        :param k: the number of movies to return, which are found with a heap instead of a full sort, or None for all
+        :param ascending: whether to rank from low to high instead of high to low
+        :param where: a function that gets a Movie and returns whether to keep it, for any other condition
+        :param filters: per attribute, a (low, high) tuple for an inclusive range in which either end may be None,
+                        or a value that should match. For the inverted indexes this can also be a list of values
+                        which should all be present.
+        :return: a list of Movie objects
+        """
+        lists = []
+        conditions = []
+        for attribute, value in filters.items():
+            if isinstance(value, tuple) and attribute in self.sorted_indexes:
+                lists.append(self.sorted_indexes[attribute].range(*value))
+            elif attribute in self.inverted_indexes or attribute in self.deferred_indexes:
+                lists += [self.get_inverted_index(attribute).crit_ids.get(v, [])
+                          for v in (value if isinstance(value, list) else [value])]
+            elif attribute in self.attribute_indexes:
+                lists.append(sorted(self.attribute_indexes[attribute].get(value)))
+            elif isinstance(value, tuple):
+                conditions.append(self.make_range_condition(attribute, *value))
+            else:
+                conditions.append(lambda movie, attribute=attribute, value=value: getattr(movie, attribute) == value)
+        if where is not None:
+            conditions.append(where)
+        if len(lists) > 0:
+            movies = (self.movies[crit_id] for crit_id in intersect_sorted(lists))
+        else:
+            movies = self.movies.values()
+        movies = (movie for movie in movies if all([condition(movie) for condition in conditions]))
+        if order_by is None:
+            movies = list(movies)
+            return movies if k is None else movies[:k]
+        key = make_getter(order_by)
+        movies = [(value, movie.crit_id, movie) for value, movie in ((key(movie), movie) for movie in movies)
+                  if value is not None]
+        if k is None:
+            movies = sorted(movies, reverse=not ascending)
+        elif ascending:
+            movies = heapq.nsmallest(k, movies)
+        else:
+            movies = heapq.nlargest(k, movies)
+        return [movie for _, _, movie in movies]
+
+    @staticmethod
+    def make_range_condition(attribute, low=None, high=None):
+        def condition(movie):
+            value = getattr(movie, attribute)
+            return value is not None and (low is None or value >= low) and (high is None or value <= high)
+        return condition
+
+    def load_table(self, tbl):
+        self.c.execute("select * from {}".format(tbl))
         return self.c.fetchall()
 
-    def load_movies(self):
+    def stream_table(self, tbl, order_by, conn=None, modified_since=None, columns=None, crit_ids=None):
+        """
+        Reads a table row by row through a streaming cursor, so that the table is never held in memory as a whole
+        :param tbl: the name of the table
+        :param order_by: the columns to sort the rows on, so that they can be grouped while they arrive
+        :param conn: a separate connection to read on, instead of the current one
+        :param modified_since: only read the rows of movies that were modified at or after this time
+        :param columns: the columns to read, or None for all of them
+        :param crit_ids: only read the rows of these movies
+        :return: a generator of row dictionaries
+        """
+        if conn is None:
+            conn = self.conn
+        sql = "select {} from {}".format('*' if columns is None else ', '.join(columns), tbl)
+        values = []
+        if modified_since is not None and tbl == 'movies':
+            sql += " where last_modified >= %s"
+            values = [modified_since]
+        elif modified_since is not None:
+            sql += " where crit_id in (select crit_id from movies where last_modified >= %s)"
+            values = [modified_since]
+        elif crit_ids is not None:
+            sql += " where crit_id in ({})".format(', '.join(['%s' for _ in crit_ids]))
+            values = list(crit_ids)
+        sql += " order by {}".format(', '.join(order_by))
+        cursor = self.new_cursor(conn, streaming=True)
+        try:
+            cursor.execute(sql, values)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+    def load_movies(self, modified_since=None):
         print("Loading movies...")
-        movies = self.load_table('movies')
+        columns = [column for column in self.columns_movies if self.is_loaded_up_front(column)]
+        movies = self.stream_table('movies', ['crit_id'], modified_since=modified_since, columns=columns)
         return {movie['crit_id']: movie for movie in movies}
 
     def load_netflix_genres(self):
@@ -309,107 +776,73 @@ class MySQLDatabase(Database):
             self.netflix_genres[k] = {'genre_names': sorted(list(set([e['genre_name'] for e in l]))),
                                       'movies_updated': max_date([e['movies_updated'] for e in l])}
 
-    def load_unogs_suspension(self):
-        print("Loading Unogs suspension...")
-        unogs_suspension = self.load_table('unogs_suspension')
-        if len(unogs_suspension) > 0:
-            self.unogs_suspension = arrow.get(unogs_suspension[0]['last_suspension'])
-        else:
-            self.unogs_suspension = None
-
-    def load_persons(self, movies):
+    def load_persons(self, movies, conn=None, modified_since=None):
         print("Loading people...")
-        persons = sorted(self.load_table('persons'),
-                         key=lambda k: (k['crit_id'], k['role'], k['rank']))
-        cast = [person for person in persons if person['role'] == 'cast']
-        cast_dict = {k: {'cast': [{'canonical_name': e['canonical_name'],
-                                   'name': e['name'],
-                                   'person_id': e['person_id']}
-                                  for e in list(v)]}
-                     for k, v in groupby(cast, key=lambda x: x['crit_id'])}
-        for k, v in cast_dict.items():
-            movies[k].update(v)
-        directors = [person for person in persons if person['role'] == 'director']
-        directors_dict = {k: {'director': [{'canonical_name': e['canonical_name'],
-                                             'name': e['name'],
-                                             'person_id': e['person_id']}
-                                            for e in list(v)]}
-                          for k, v in groupby(directors, key=lambda x: x['crit_id'])}
-        for k, v in directors_dict.items():
-            movies[k].update(v)
-        writers = [person for person in persons if person['role'] == 'writer']
-        writers_dict = {k: {'writer': [{'canonical_name': e['canonical_name'],
-                                         'name': e['name'],
-                                         'person_id': e['person_id']}
-                                        for e in list(v)]}
-                        for k, v in groupby(writers, key=lambda x: x['crit_id'])}
-        for k, v in writers_dict.items():
-            movies[k].update(v)
-
-    def load_genres(self, movies):
+        persons = self.stream_table('persons', ['crit_id', 'role', 'rank'], conn=conn,
+                                    modified_since=modified_since)
+        for crit_id, crit_persons in group_by_movie(persons, movies):
+            for role, role_persons in groupby(crit_persons, key=itemgetter('role')):
+                if role in ('cast', 'director', 'writer'):
+                    movies[crit_id][role] = [person_registry.get(e['person_id'], e['name'], e['canonical_name'])
+                                             for e in role_persons]
+
+    def load_genres(self, movies, conn=None, modified_since=None):
         print("Loading genres...")
-        genres = sorted(self.load_table('genres'), key=lambda k: k['crit_id'])
-        genre_dict = {k: {'genres': [e['genre'] for e in list(v)]}
-                      for k, v in groupby(genres, key=lambda x: x['crit_id'])}
-        for k, v in genre_dict.items():
-            movies[k].update(v)
+        genres = self.stream_table('genres', ['crit_id', 'genre'], conn=conn,
+                                   modified_since=modified_since)
+        for crit_id, v in group_by_movie(genres, movies):
+            movies[crit_id]['genres'] = [intern_string(e['genre']) for e in v]
 
-    def load_countries(self, movies):
+    def load_countries(self, movies, conn=None, modified_since=None):
         print("Loading countries...")
-        countries = sorted(self.load_table('countries'), key=lambda k: (k['crit_id'], k['rank']))
-        country_dict = {k: {'countries': [e['country'] for e in list(v)]}
-                        for k, v in groupby(countries, key=lambda x: x['crit_id'])}
-        for k, v in country_dict.items():
-            movies[k].update(v)
+        countries = self.stream_table('countries', ['crit_id', 'rank'], conn=conn,
+                                      modified_since=modified_since)
+        for crit_id, v in group_by_movie(countries, movies):
+            movies[crit_id]['countries'] = [intern_string(e['country']) for e in v]
 
-    def load_languages(self, movies):
+    def load_languages(self, movies, conn=None, modified_since=None):
         print("Loading languages...")
-        languages = sorted(self.load_table('languages'), key=lambda k: (k['crit_id'], k['rank']))
-        language_dict = {k: {'languages': [e['language'] for e in list(v)]}
-                         for k, v in groupby(languages, key=lambda x: x['crit_id'])}
-        for k, v in language_dict.items():
-            movies[k].update(v)
+        languages = self.stream_table('languages', ['crit_id', 'rank'], conn=conn,
+                                      modified_since=modified_since)
+        for crit_id, v in group_by_movie(languages, movies):
+            movies[crit_id]['languages'] = [intern_string(e['language']) for e in v]
 
-    def load_keywords(self, movies):
+    def load_keywords(self, movies, conn=None, modified_since=None, crit_ids=None):
         print("Loading keywords...")
-        keywords = sorted(self.load_table('keywords'), key=lambda k: k['crit_id'])
-        keyword_dict = {k: {'keywords': [e['keyword'] for e in list(v)]}
-                        for k, v in groupby(keywords, key=lambda x: x['crit_id'])}
-        for k, v in keyword_dict.items():
-            movies[k].update(v)
+        keywords = self.stream_table('keywords', ['crit_id', 'keyword'], conn=conn,
+                                     modified_since=modified_since, crit_ids=crit_ids)
+        for crit_id, v in group_by_movie(keywords, movies):
+            movies[crit_id]['keywords'] = [intern_string(e['keyword']) for e in v]
 
-    def load_taglines(self, movies):
+    def load_taglines(self, movies, conn=None, modified_since=None, crit_ids=None):
         print("Loading taglines...")
-        taglines = sorted(self.load_table('taglines'), key=lambda k: (k['crit_id'], k['rank']))
-        taglines_dict = {k: {'taglines': [e['tagline'] for e in list(v)]}
-                         for k, v in groupby(taglines, key=lambda x: x['crit_id'])}
-        for k, v in taglines_dict.items():
-            movies[k].update(v)
+        taglines = self.stream_table('taglines', ['crit_id', 'rank'], conn=conn,
+                                     modified_since=modified_since, crit_ids=crit_ids)
+        for crit_id, v in group_by_movie(taglines, movies):
+            movies[crit_id]['taglines'] = [e['tagline'] for e in v]
 
-    def load_vote_details(self, movies):
+    def load_vote_details(self, movies, conn=None, modified_since=None, crit_ids=None):
         print("Loading vote details...")
-        vote_details = sorted(self.load_table('vote_details'), key=lambda k: k['crit_id'])
-        vote_details_dict = {k: {'vote_details': {e['demographic']: {'rating': e['rating'], 'votes': e['votes']}
-                                                  for e in list(v)}}
-                             for k, v in groupby(vote_details, key=lambda x: x['crit_id'])}
-        for k, v in vote_details_dict.items():
-            movies[k].update(v)
-
-    def load_ratings(self, movies):
+        vote_details = self.stream_table('vote_details', ['crit_id', 'demographic'], conn=conn,
+                                         modified_since=modified_since, crit_ids=crit_ids)
+        for crit_id, v in group_by_movie(vote_details, movies):
+            movies[crit_id]['vote_details'] = {e['demographic']: {'rating': e['rating'], 'votes': e['votes']}
+                                               for e in v}
+
+    def load_ratings(self, movies, conn=None, modified_since=None):
         print("Loading ratings...")
-        ratings = sorted(self.load_table('ratings'), key=lambda k: k['crit_id'])
-        ratings_dict = {crit_id: {'my_ratings': {user: {rating['type']: rating['score'] for rating in list(user_ratings)}
-                                                 for user, user_ratings in groupby(crit_values, key=lambda x: x['user'])}}
-                        for crit_id, crit_values in groupby(ratings, key=lambda x: x['crit_id'])}
-        for k, v in ratings_dict.items():
-            movies[k].update(v)
+        ratings = self.stream_table('ratings', ['crit_id', 'user', 'type'], conn=conn,
+                                    modified_since=modified_since)
+        for crit_id, crit_ratings in group_by_movie(ratings, movies):
+            movies[crit_id]['my_ratings'] = {user: {rating['type']: rating['score'] for rating in user_ratings}
+                                             for user, user_ratings in groupby(crit_ratings, key=itemgetter('user'))}
 
     def everything_to_movie(self, movies):
         print("Creating Movie objects...")
-        for movie_info in movies.values():
-            self.movies[movie_info['crit_id']] = Movie(movie_info)
+        for movie in Movie.from_records(movies.values()):
+            self.movies[movie.crit_id] = movie
 
-    def set_movie(self, movie):
+    def merge_movie(self, movie):
         if isinstance(movie, dict):
             if movie['crit_id'] in self.movies:
                 self.movies[movie['crit_id']].update_from_dict(movie)
@@ -422,20 +855,75 @@ class MySQLDatabase(Database):
                 self.movies[movie.crit_id] = movie
         else:
             raise Exception("No dict or Movie object was provided.")
-        self.update_single_record('movies', self.movie_to_dict_movies(movie))
-        self.update_multiple_records('persons', self.movie_to_dict_persons(movie))
-        self.update_multiple_records('genres', self.movie_to_dict_genres(movie))
-        self.update_multiple_records('countries', self.movie_to_dict_countries(movie))
-        self.update_multiple_records('languages', self.movie_to_dict_languages(movie))
-        self.update_multiple_records('keywords', self.movie_to_dict_keywords(movie))
-        self.update_multiple_records('taglines', self.movie_to_dict_taglines(movie))
-        self.update_multiple_records('ratings', self.movie_to_dict_ratings(movie))
-        self.update_multiple_records('vote_details', self.movie_to_dict_vote_details(movie))
+        self.update_indexes(movie)
+        return movie
+
+    @staticmethod
+    def is_new_movie(movie):
+        # The criticker id only shows up as a changed attribute if the movie was never loaded or saved
+        return 'crit_id' in movie.changed_attributes
+
+    def get_changed_movie_columns(self, movie):
+        return [k for k in sorted(movie.changed_attributes) if k in self.columns_movies]
+
+    def get_changed_child_tables(self, movie):
+        return [tbl for tbl, attributes in self.child_tables.items()
+                if len(movie.changed_attributes.intersection(attributes)) > 0]
+
+    def set_movie(self, movie):
+        with self.lock:
+            movie = self.merge_movie(movie)
+            if len(movie.changed_attributes) == 0:
+                return
+            with self.connection():
+                if self.is_new_movie(movie):
+                    self.update_single_record('movies', self.movie_to_dict_movies(movie))
+                else:
+                    columns = self.get_changed_movie_columns(movie)
+                    if len(columns) > 0:
+                        self.update_record('movies', self.movie_to_dict_movies(movie, columns=columns))
+                for tbl in self.get_changed_child_tables(movie):
+                    self.update_multiple_records(tbl, getattr(self, 'movie_to_dict_' + tbl)(movie))
+                self.touch_movies([movie.crit_id])
+            movie.reset_changed_attributes()
+
+    def set_movies(self, movies):
+        """
+        Saves a batch of movies using one connection and a single transaction
+        :param movies: a list of movie dictionaries and/or Movie objects
+        """
+        with self.lock:
+            movies = [self.merge_movie(movie) for movie in movies]
+            movies = [movie for movie in {movie.crit_id: movie for movie in movies}.values()
+                      if len(movie.changed_attributes) > 0]
+            if len(movies) == 0:
+                return
+            with self.connection():
+                self.upsert_records('movies', [self.movie_to_dict_movies(movie) for movie in movies
+                                               if self.is_new_movie(movie)])
+                self.update_records('movies', [self.movie_to_dict_movies(movie,
+                                                                         columns=self.get_changed_movie_columns(movie))
+                                               for movie in movies if not self.is_new_movie(movie)])
+                for tbl in self.child_tables:
+                    movie_to_dict = getattr(self, 'movie_to_dict_' + tbl)
+                    self.store_multiple_records(tbl, [movie_to_dict(movie) for movie in movies
+                                                      if tbl in self.get_changed_child_tables(movie)])
+                self.touch_movies([movie.crit_id for movie in movies])
+            for movie in movies:
+                movie.reset_changed_attributes()
+
+    def touch_movies(self, crit_ids):
+        """
+        Marks movies as modified, so that a refresh also picks up changes to their child rows. Does not commit.
+        :param crit_ids: a list of criticker ids
+        """
+        sql = "update movies set last_modified = {} where crit_id in ({})"\
+            .format(self.now_sql, ', '.join(['%s' for _ in crit_ids]))
+        self.c.execute(sql, crit_ids)
 
     def set_netflix_genres(self):
-        self.connect()
-        self.c.execute("truncate table netflix_genres")
-        self.close()
+        with self.connection():
+            self.c.execute("delete from netflix_genres")
         for genre in self.netflix_genres:
             netflix_genre_dict = {'genreid': genre,
                                   'genre_name': self.netflix_genres[genre]['genre_names']}
@@ -444,21 +932,30 @@ class MySQLDatabase(Database):
                 netflix_genre_dict['n_rows']
             self.update_multiple_records('netflix_genres', netflix_genre_dict, key='genreid')
 
-    def set_unogs_suspension(self):
-        self.update_single_record('unogs_suspension', {'id': 1, 'last_suspension': self.unogs_suspension})
-
     def update_single_record(self, tbl, d):
-        self.connect()
-        d = self.make_dict_db_safe(d)
-        sql = "insert into {} (".format(tbl)
-        sql += ', '.join([k for k in sorted(d)])
-        sql += ') values ('
-        sql += ', '.join(['%s' for _ in d])
-        sql += ') on duplicate key update '
-        sql += ', '.join(['{} = %s'.format(k) for k in sorted(d)])
-        values = [d[k] for k in sorted(d)] + [d[k] for k in sorted(d)]
-        self.c.execute(sql, values)
-        self.close()
+        with self.connection():
+            self.upsert_records(tbl, [d])
+
+    def update_record(self, tbl, d, key='crit_id'):
+        with self.connection():
+            self.update_records(tbl, [d], key=key)
+
+    def update_records(self, tbl, records, key='crit_id'):
+        """
+        Updates columns of many existing records, without committing
+        :param tbl: the name of the table
+        :param records: a list of dictionaries, which may each have a different set of columns
+        :param key: the column identifying the record to update
+        """
+        records_per_columns = {}
+        for d in records:
+            d = self.make_dict_db_safe(d)
+            columns = tuple(sorted([k for k in d if k != key]))
+            if len(columns) > 0:
+                records_per_columns.setdefault(columns, []).append(d)
+        for columns, records_with_columns in records_per_columns.items():
+            sql = "update {} set {} where {} = %s".format(tbl, ', '.join(['{} = %s'.format(k) for k in columns]), key)
+            self.c.executemany(sql, [[d[k] for k in columns] + [d[key]] for d in records_with_columns])
 
     def create_insert_multiple_records_sql(self, tbl, d, key='crit_id'):
         d = self.make_dict_db_safe(d)
@@ -475,39 +972,96 @@ class MySQLDatabase(Database):
 
     def update_multiple_records(self, tbl, d, key='crit_id'):
         d = self.make_dict_db_safe(d)
-        if d['n_rows'] > 0:
-            self.connect()
-            # Delete existing rows
-            sql = "delete from {} where {} = %s".format(tbl, key)
-            values = [d[key]]
-            self.c.execute(sql, values)
-            self.conn.commit()
-            # Add new rows
-            sql, values = self.create_insert_multiple_records_sql(tbl, d, key=key)
-            self.c.execute(sql, values)
-            self.close()
+        if d['n_rows'] > 0 and self.sync_mode == 'diff':
+            with self.connection():
+                self.sync_multiple_records(tbl, [d], key=key)
+        elif d['n_rows'] > 0:
+            with self.connection():
+                # Delete existing rows
+                sql = "delete from {} where {} = %s".format(tbl, key)
+                values = [d[key]]
+                self.c.execute(sql, values)
+                self.conn.commit()
+                # Add new rows
+                sql, values = self.create_insert_multiple_records_sql(tbl, d, key=key)
+                self.c.execute(sql, values)
+
+    def upsert_records(self, tbl, records):
+        """
+        Inserts or updates many records with multi-row statements, without committing
+        :param tbl: the name of the table
+        :param records: a list of dictionaries, which may each have a different set of columns
+        """
+        records_per_columns = {}
+        for d in records:
+            d = self.make_dict_db_safe(d)
+            records_per_columns.setdefault(tuple(sorted(d)), []).append(d)
+        for columns, records_with_columns in records_per_columns.items():
+            sql = self.get_upsert_sql(tbl, columns)
+            self.c.executemany(sql, [[d[k] for k in columns] for d in records_with_columns])
+
+    def get_upsert_sql(self, tbl, columns):
+        raise NotImplementedError
+
+    def replace_multiple_records(self, tbl, ds, key='crit_id'):
+        """
+        Replaces the rows of many keys at once with one delete and one multi-row insert, without committing
+        :param tbl: the name of the table
+        :param ds: a list of dictionaries in the format of update_multiple_records
+        :param key: the column identifying the rows belonging to a single dictionary
+        """
+        ds = [self.make_dict_db_safe(d) for d in ds if d['n_rows'] > 0]
+        if len(ds) == 0:
+            return
+        keys = [k for k in ds[0].keys() if k not in [key, 'n_rows']]
+        sql = "delete from {} where {} in ({})".format(tbl, key, ', '.join(['%s' for _ in ds]))
+        self.c.execute(sql, [d[key] for d in ds])
+        sql = "insert into {} ({}, {}) values (%s, {})".format(tbl, key, ', '.join(keys),
+                                                               ', '.join(['%s' for _ in keys]))
+        values = [[d[key]] + [d[k][i] for k in keys] for d in ds for i in range(d['n_rows'])]
+        self.c.executemany(sql, values)
+
+    def store_multiple_records(self, tbl, ds, key='crit_id'):
+        if self.sync_mode == 'diff':
+            self.sync_multiple_records(tbl, ds, key=key)
+        else:
+            self.replace_multiple_records(tbl, ds, key=key)
+
+    def sync_multiple_records(self, tbl, ds, key='crit_id'):
+        """
+        Makes the stored rows of many keys equal to the given rows by comparing them on the primary key,
+        so that only the rows that differ are deleted, inserted or updated. Does not commit.
+        :param tbl: the name of the table
+        :param ds: a list of dictionaries in the format of update_multiple_records
+        :param key: the column identifying the rows belonging to a single dictionary
+        """
+        ds = [self.make_dict_db_safe(d) for d in ds if d['n_rows'] > 0]
+        if len(ds) == 0:
+            return
+        primary_keys = self.primary_keys[tbl]
+        columns = [key] + [k for k in ds[0].keys() if k not in [key, 'n_rows']]
+        new_rows = {}
+        for d in ds:
+            for i in range(d['n_rows']):
+                row = {k: d[key] if k == key else d[k][i] for k in columns}
+                new_rows[tuple([row[k] for k in primary_keys])] = row
+        sql = "select {} from {} where {} in ({})".format(', '.join(columns), tbl, key, ', '.join(['%s' for _ in ds]))
+        self.c.execute(sql, [d[key] for d in ds])
+        old_rows = {tuple([row[k] for k in primary_keys]): row for row in self.c.fetchall()}
+        deleted_rows = [list(pk) for pk in old_rows if pk not in new_rows]
+        changed_rows = [row for pk, row in new_rows.items() if old_rows.get(pk) != row]
+        if len(deleted_rows) > 0:
+            sql = "delete from {} where {}".format(tbl, ' and '.join(['{} = %s'.format(k) for k in primary_keys]))
+            self.c.executemany(sql, deleted_rows)
+        if len(changed_rows) > 0:
+            self.upsert_records(tbl, changed_rows)
 
     def remove_table(self, table_name='movies'):
-        self.connect()
-        self.c.execute("drop table if exists {}".format(table_name))
-        self.close()
+        with self.connection():
+            self.c.execute("drop table if exists {}".format(table_name))
 
     def add_column(self, column_name, column_datatype, table_name='movies', after=None, first=False):
-        sql = "alter table {} add column {} {}".format(table_name, column_name, column_datatype)
-        if first:
-            sql += " first"
-            if after is not None:
-                raise Exception("Can't use both 'after' and 'first' keyword parameters'")
-        elif after is not None:
-            sql += " after {}".format(after)
-        try:
-            self.c.execute(sql)
-        except pymysql.err.InternalError as e:
-            if not e.args[0] == 1060:
-                print(e)
-                raise Exception
-            else:
-                print("{} already in table {}".format(e.args[1], table_name))
+        raise NotImplementedError
 
     def add_columns(self, columns, table_name='movies'):
         if isinstance(table_name, str):
@@ -525,14 +1079,7 @@ class MySQLDatabase(Database):
     def add_missing_columns(self, table_name):
         desired_columns = getattr(self, 'columns_' + table_name)
         desired_columns = {k: {'column_name': k, 'column_type': desired_columns[k]} for k in desired_columns}
-        self.c.execute("""
-            SELECT column_name,
-                   column_type
-              FROM information_schema.columns 
-             WHERE table_name='{}'
-               AND table_schema='{}'
-            """.format(table_name, self.schema))
-        actual_columns = {d['column_name']: d for d in self.c.fetchall()}
+        actual_columns = self.get_table_columns(table_name)
         if len(actual_columns) == 0:
             # Table is missing!
             self.initialize(tbls=[table_name])
@@ -549,11 +1096,43 @@ class MySQLDatabase(Database):
                 print("Adding column {}".format(col))
                 self.add_column(col, desired_columns[col]['column_type'],
                                 table_name=table_name, after=after, first=first)
+            elif desired_columns[col]['column_type'].startswith('datetime') \
+                    and actual_columns[col].lower().startswith('varchar'):
+                print("Converting column {} to datetime".format(col))
+                self.convert_to_datetime(table_name, col)
 
-    def movie_to_dict_movies(self, movie):
-        d = {k: v for k, v in vars(movie).items()
-             if v is not None and k in self.columns_movies.keys()}
-        return d
+    def convert_to_datetime(self, table_name, column):
+        """
+        Converts a column of formatted date strings to a datetime column. The strings are first rewritten in UTC,
+        in a format the database understands, so that they keep representing the same moment.
+        """
+        primary_keys = self.primary_keys[table_name]
+        self.c.execute("select {}, {} from {} where {} is not null".format(
+            ', '.join(primary_keys), column, table_name, column))
+        rows = [[arrow_to_db(arrow.get(row[column]))] + [row[k] for k in primary_keys] for row in self.c.fetchall()]
+        if len(rows) > 0:
+            sql = "update {} set {} = %s where {}".format(
+                table_name, column, ' and '.join(['{} = %s'.format(k) for k in primary_keys]))
+            self.c.executemany(sql, rows)
+        self.change_column_type(table_name, column, getattr(self, 'columns_' + table_name)[column])
+
+    def change_column_type(self, table_name, column, column_type):
+        raise NotImplementedError
+
+    def get_table_columns(self, table_name):
+        """
+        :return: a dictionary with the type of each column of the table, which is empty if the table doesn't exist
+        """
+        raise NotImplementedError
+
+    def movie_to_dict_movies(self, movie, columns=None):
+        if columns is None:
+            columns = self.columns_movies.keys()
+        else:
+            columns = ['crit_id'] + list(columns)
+        # Only the requested attributes are read, so that lazy attributes aren't loaded needlessly
+        d = {k: getattr(movie, k) for k in columns if k in ATTRIBUTES}
+        return {k: v for k, v in d.items() if v is not None}
 
     @staticmethod
     def process_persons(person_dict, persons, role):
@@ -683,19 +1262,292 @@ class MySQLDatabase(Database):
             ratings_dict['n_rows'] = len(records)
         return ratings_dict
 
-    def save_movies(self, movies, verbose=True):
+    def save_movies(self, movies, verbose=True, chunk_size=1000):
         if verbose:
             print("\nSaving movie information to the database...\n")
         time0 = time.time()
-        for i, movie_info in enumerate(movies):
-            if i > 0 and (i+1) % 1000 == 0:
+        for i in range(0, len(movies), chunk_size):
+            if i > 0:
                 print("   Saving movie {} out of {}".format(i+1, len(movies)))
-            self.set_movie(movie_info)
+            self.set_movies(movies[i:i+chunk_size])
         time_taken = time.time() - time0
         if verbose:
             print("...took {:.1f} minuters".format(time_taken/60))
             self.print()
 
+    def get_movies_not_updated_since(self, column, since):
+        """
+        Gets the movies for which a source was never updated, or was last updated before a certain moment
+        :param column: the column with the update times, e.g. 'omdb_updated'
+        :param since: an Arrow object
+        :return: a list of criticker ids
+        """
+        with self.connection():
+            self.c.execute("select crit_id from movies where {0} is null or {0} < %s".format(column),
+                           [arrow_to_db(since)])
+            crit_ids = [row['crit_id'] for row in self.c.fetchall()]
+        return crit_ids
+
+    def set_schedule(self, entries):
+        """
+        Stores when sources of movies should be updated next
+        :param entries: (crit_id, source, next_update, period) tuples, with next_update an Arrow object
+                        or a naive datetime in UTC, and the update period in weeks
+        """
+        with self.lock:
+            with self.connection():
+                sql = self.get_upsert_sql('schedule', ['crit_id', 'source', 'next_update', 'period'])
+                self.c.executemany(sql, [[crit_id, source, arrow_to_db(next_update) if isinstance(next_update, Arrow)
+                                          else next_update, period]
+                                         for crit_id, source, next_update, period in entries])
+
+    def load_schedule(self):
+        """
+        :return: all rows of the schedule, with next_update as a naive datetime in UTC
+        """
+        with self.connection():
+            rows = list(self.stream_table('schedule', ['next_update']))
+        return rows
+
+    def set_rate_limits(self, buckets):
+        """
+        Stores the state of token buckets of the rate limiter
+        :param buckets: (host, tokens, updated, suspended_until) tuples, with the times as naive datetimes in UTC
+        """
+        with self.lock:
+            with self.connection():
+                sql = self.get_upsert_sql('rate_limits', ['host', 'tokens', 'updated', 'suspended_until'])
+                self.c.executemany(sql, [list(bucket) for bucket in buckets])
+
+    def load_rate_limits(self):
+        """
+        :return: all rows of rate_limits, with the times as naive datetimes in UTC
+        """
+        with self.lock:
+            with self.connection():
+                rows = self.load_table('rate_limits')
+        return rows
+
+    def get_movie(self, crit_id):
+        try:
+            return self.movies[crit_id]
+        except KeyError as e:
+            print("CritickerID {} does not exist in the database.".format(e.args[0]))
+            raise MovieNotInDatabaseError(crit_id=crit_id)
+
+    def print(self):
+        epoch = np.datetime64('1970-01-01', 'us')
+        last_updated = np.maximum(self.column_store.column('criticker_updated', fill=epoch),
+                                  self.column_store.column('omdb_updated', fill=epoch))
+        rows = np.argsort(last_updated, kind='stable')[::-1][:10]
+        for crit_id in self.column_store.crit_ids[rows]:
+            self.movies[int(crit_id)].print()
+        print("\n")
+
+    @staticmethod
+    def make_dict_db_safe(d):
+        d = copy.deepcopy(d)
+        for k in d:
+            if isinstance(d[k], Arrow):
+                d[k] = arrow_to_db(d[k])
+            if isinstance(d[k], list):
+                d[k] = [arrow_to_db(e) if isinstance(e, Arrow) else e for e in d[k]]
+        return d
+
+
+def arrow_to_db(a):
+    """
+    Converts an Arrow object to the naive UTC datetime that is stored in datetime columns
+    """
+    return a.to('UTC').naive
+
+
+def group_by_movie(rows, movies):
+    """
+    Groups child rows that are sorted on crit_id per movie, leaving out the movies that weren't loaded.
+    A child table is read in a separate statement, which can already see movies that were added after the movies
+    table was read. The next refresh loads those.
+    :param movies: a dictionary of movie dictionaries, or a defaultdict to collect the rows of every movie,
+                   as load_in_parallel does while the movies table is still being read
+    """
+    collect_all = isinstance(movies, defaultdict)
+    for crit_id, rows_of_movie in groupby(rows, key=itemgetter('crit_id')):
+        if collect_all or crit_id in movies:
+            yield crit_id, rows_of_movie
+
+
+def max_date(l):
+    if len(l) > 0:
+        m = max([e for e in l if e is not None], default=None)
+        if m is not None:
+            return arrow.get(m)
+        else:
+            return None
+    else:
+        return None
+
+
+class MySQLDatabase(Database):
+    def __init__(self, from_scratch=False, schema='qmdb', env='prd', pool_size=4, max_idle=600, sync_mode='diff',
+                 load_threads=1, snapshot_path=None, load_profile='full', lazy_batch_size=1000):
+        if env == 'prd':
+            self.config = config.mysql_prd
+        else:
+            self.config = config.mysql_tst
+        self.schema = schema
+        self.now_sql = 'current_timestamp(6)'
+        self.pool = ConnectionPool(self.new_connection, size=pool_size, max_idle=max_idle)
+        super().__init__(from_scratch=from_scratch, sync_mode=sync_mode, load_threads=load_threads,
+                         snapshot_path=snapshot_path, load_profile=load_profile,
+                         lazy_batch_size=lazy_batch_size)
+
+    def load_or_initialize(self, from_scratch=False):
+        try:
+            super().load_or_initialize(from_scratch=from_scratch)
+        except pymysql.err.ProgrammingError:
+            print("Something went wrong trying to load the tables.")
+            raise Exception
+
+    def new_connection(self):
+        return pymysql.connect(host=self.config['host'],
+                               user=self.config['username'],
+                               password=self.config['password'],
+                               db=self.schema,
+                               charset='utf8mb4',
+                               use_unicode=True,
+                               cursorclass=pymysql.cursors.DictCursor)
+
+    def get_connection(self):
+        return self.pool.get()
+
+    def release_connection(self, conn):
+        self.pool.put(conn)
+
+    def discard_connection(self, conn):
+        self.pool.discard(conn)
+
+    def new_cursor(self, conn, streaming=False):
+        if streaming:
+            return conn.cursor(pymysql.cursors.SSDictCursor)
+        return conn.cursor()
+
+    def disconnect(self):
+        self.pool.close()
+
+    def create_table(self, table_name, column_info, primary_keys, indexes):
+        self.check_table_definition(primary_keys, indexes)
+        self.c.execute("drop table if exists {}".format(table_name))
+        print("Creating table {}.{}".format(self.schema, table_name))
+        sql = """
+            CREATE TABLE {} (
+                {},
+                PRIMARY KEY({}){}
+            ) DEFAULT CHARSET=utf8mb4
+            """.format(table_name,
+                       ', '.join(["{} {}".format(k, v) for k, v in column_info.items()]),
+                       ', '.join(primary_keys),
+                       ''.join([', INDEX {}({})'.format(self.get_index_name(table_name, columns), ', '.join(columns))
+                                for columns in indexes]))
+        self.c.execute(sql)
+
+    def drop_index(self, table_name, index_name):
+        self.c.execute("drop index {} on {}".format(index_name, table_name))
+
+    def get_table_indexes(self, table_name):
+        self.c.execute("""
+            SELECT index_name AS index_name,
+                   column_name AS column_name
+              FROM information_schema.statistics
+             WHERE table_name = %s
+               AND table_schema = %s
+               AND index_name != 'PRIMARY'
+             ORDER BY index_name, seq_in_index
+            """, [table_name, self.schema])
+        indexes = {}
+        for row in self.c.fetchall():
+            indexes.setdefault(row['index_name'], []).append(row['column_name'])
+        return indexes
+
+    def get_fingerprint(self):
+        """
+        Gets a cheap summary of the movies and Netflix genres, without scanning the large child tables.
+        Unlike the SQLite fingerprint, it doesn't count the rows of the child tables. It relies on set_movie and
+        set_movies, which update the last_modified of a movie also when only its child rows changed, just like
+        refresh does. Child rows that are written or deleted in another way, without touching their movie,
+        aren't noticed, and leave the snapshot stale until that movie is saved again.
+        :return: a dictionary with the row count and last modification of the movies and the Netflix genres
+        """
+        self.c.execute("select count(*) as n_rows, max(last_modified) as last_modified from movies")
+        fingerprint = dict(self.c.fetchone())
+        self.c.execute("select count(*) as n_genres, max(movies_updated) as genres_updated from netflix_genres")
+        fingerprint.update(self.c.fetchone())
+        return fingerprint
+
+    def load_in_parallel(self, child_loaders):
+        """
+        Loads the child tables concurrently, each on its own pooled connection, while the movies table is loaded
+        on the current connection. The child rows are merged into the movie dictionaries afterwards.
+        :param child_loaders: the load methods of the child tables
+        :return: a dictionary of movie dictionaries
+        """
+        def load_separately(loader):
+            conn = self.pool.get()
+            try:
+                child_info = defaultdict(dict)
+                loader(child_info, conn=conn)
+            except:
+                self.pool.discard(conn)
+                raise
+            self.pool.put(conn)
+            return child_info
+
+        with ThreadPoolExecutor(max_workers=self.load_threads) as executor:
+            futures = [executor.submit(load_separately, loader) for loader in child_loaders]
+            movies = self.load_movies()
+            for future in futures:
+                for crit_id, info in future.result().items():
+                    # The child tables are read in other transactions, which can see movies that were added
+                    # after the movies table was read. Those are loaded with the next refresh.
+                    if crit_id in movies:
+                        movies[crit_id].update(info)
+        return movies
+
+    @staticmethod
+    def get_upsert_sql(tbl, columns):
+        return "insert into {} ({}) values ({}) on duplicate key update {}".format(
+            tbl, ', '.join(columns), ', '.join(['%s' for _ in columns]),
+            ', '.join(['{0} = values({0})'.format(k) for k in columns]))
+
+    def add_column(self, column_name, column_datatype, table_name='movies', after=None, first=False):
+        sql = "alter table {} add column {} {}".format(table_name, column_name, column_datatype)
+        if first:
+            sql += " first"
+            if after is not None:
+                raise Exception("Can't use both 'after' and 'first' keyword parameters'")
+        elif after is not None:
+            sql += " after {}".format(after)
+        try:
+            self.c.execute(sql)
+        except pymysql.err.InternalError as e:
+            if not e.args[0] == 1060:
+                print(e)
+                raise Exception
+            else:
+                print("{} already in table {}".format(e.args[1], table_name))
+
+    def get_table_columns(self, table_name):
+        self.c.execute("""
+            SELECT column_name AS column_name,
+                   column_type AS column_type
+              FROM information_schema.columns
+             WHERE table_name = %s
+               AND table_schema = %s
+            """, [table_name, self.schema])
+        return {d['column_name']: d['column_type'] for d in self.c.fetchall()}
+
+    def change_column_type(self, table_name, column, column_type):
+        self.c.execute("alter table {} modify column {} {}".format(table_name, column, column_type))
+
 
 class MovieNotInDatabaseError(Exception):
     def __init__(self, crit_id=None):
@@ -0,0 +1,173 @@
+from bisect import bisect_left, bisect_right, insort
+
+
+class AttributeIndex:
+    def __init__(self, attribute):
+        """
+        Maps the values of a movie attribute to the criticker ids of the movies that have them.
+        The indexed value of each movie is remembered as well, so that a movie can be moved to its new value
+        without searching for the old one.
+        :param attribute: the name of the Movie attribute to index
+        """
+        self.attribute = attribute
+        self.crit_ids = {}
+        self.values = {}
+
+    def build(self, movies):
+        self.crit_ids = {}
+        self.values = {}
+        for movie in movies:
+            self.update(movie)
+
+    def update(self, movie):
+        value = getattr(movie, self.attribute)
+        if self.values.get(movie.crit_id) == value:
+            return
+        self.remove(movie.crit_id)
+        if value is not None:
+            self.crit_ids.setdefault(value, set()).add(movie.crit_id)
+            self.values[movie.crit_id] = value
+
+    def remove(self, crit_id):
+        value = self.values.pop(crit_id, None)
+        if value is not None:
+            crit_ids = self.crit_ids[value]
+            crit_ids.discard(crit_id)
+            if len(crit_ids) == 0:
+                del self.crit_ids[value]
+
+    def get(self, value):
+        """
+        :return: the set of criticker ids of the movies with this value, which is empty if there are none
+        """
+        return set(self.crit_ids.get(value, set()))
+
+
+class InvertedIndex:
+    def __init__(self, attribute, key=None):
+        """
+        Maps each value in a list attribute of the movies, such as a genre or a person, to the sorted list of
+        criticker ids of the movies that have it
+        :param attribute: the name of the Movie attribute to index
+        :param key: for lists of dictionaries, the key of the value to index, e.g. 'person_id'
+        """
+        self.attribute = attribute
+        self.key = key
+        self.crit_ids = {}
+        self.values = {}
+
+    def get_values(self, movie):
+        items = getattr(movie, self.attribute)
+        if items is None:
+            return frozenset()
+        if self.key is not None:
+            return frozenset([item.get(self.key) for item in items if item.get(self.key) is not None])
+        return frozenset(items)
+
+    def build(self, movies):
+        self.build_from_values((movie.crit_id, self.get_values(movie)) for movie in movies)
+
+    def build_from_values(self, values):
+        """
+        Builds the index without going through the movies, e.g. from rows that were read from the database
+        :param values: an iterable of (crit_id, values) tuples
+        """
+        self.crit_ids = {}
+        self.values = {}
+        for crit_id, movie_values in values:
+            movie_values = frozenset(movie_values)
+            if len(movie_values) > 0:
+                self.values[crit_id] = movie_values
+            for value in movie_values:
+                self.crit_ids.setdefault(value, []).append(crit_id)
+        for crit_ids in self.crit_ids.values():
+            crit_ids.sort()
+
+    def update(self, movie):
+        old_values = self.values.get(movie.crit_id, frozenset())
+        new_values = self.get_values(movie)
+        if new_values == old_values:
+            return
+        for value in old_values - new_values:
+            self.remove_crit_id(value, movie.crit_id)
+        for value in new_values - old_values:
+            insort(self.crit_ids.setdefault(value, []), movie.crit_id)
+        if len(new_values) > 0:
+            self.values[movie.crit_id] = new_values
+        else:
+            del self.values[movie.crit_id]
+
+    def remove(self, crit_id):
+        for value in self.values.pop(crit_id, frozenset()):
+            self.remove_crit_id(value, crit_id)
+
+    def remove_crit_id(self, value, crit_id):
+        crit_ids = self.crit_ids[value]
+        del crit_ids[bisect_left(crit_ids, crit_id)]
+        if len(crit_ids) == 0:
+            del self.crit_ids[value]
+
+    def get(self, value):
+        """
+        :return: the sorted list of criticker ids of the movies with this value
+        """
+        return list(self.crit_ids.get(value, []))
+
+
+def intersect_sorted(lists):
+    """
+    Intersects sorted lists by looking up each element of the shortest list in the others with a binary search
+    :return: a sorted list
+    """
+    if len(lists) == 0:
+        return []
+    lists = sorted(lists, key=len)
+    result = []
+    for e in lists[0]:
+        for l in lists[1:]:
+            i = bisect_left(l, e)
+            if i == len(l) or l[i] != e:
+                break
+        else:
+            result.append(e)
+    return result
+
+
+class SortedIndex:
+    def __init__(self, attribute):
+        """
+        Keeps the movies sorted on a numeric attribute, so that range filters only need two binary searches
+        :param attribute: the name of the Movie attribute to index
+        """
+        self.attribute = attribute
+        self.entries = []
+        self.values = {}
+
+    def build(self, movies):
+        self.values = {movie.crit_id: getattr(movie, self.attribute) for movie in movies
+                       if getattr(movie, self.attribute) is not None}
+        self.entries = sorted([(value, crit_id) for crit_id, value in self.values.items()])
+
+    def update(self, movie):
+        value = getattr(movie, self.attribute)
+        if self.values.get(movie.crit_id) == value:
+            return
+        self.remove(movie.crit_id)
+        if value is not None:
+            insort(self.entries, (value, movie.crit_id))
+            self.values[movie.crit_id] = value
+
+    def remove(self, crit_id):
+        value = self.values.pop(crit_id, None)
+        if value is not None:
+            del self.entries[bisect_left(self.entries, (value, crit_id))]
+
+    def range(self, low=None, high=None):
+        """
+        :param low: the lowest value to include, or None for no lower bound
+        :param high: the highest value to include, or None for no upper bound
+        :return: the sorted list of criticker ids of the movies with a value in the range
+        """
+        start = 0 if low is None else bisect_left(self.entries, (low, float('-inf')))
+        end = len(self.entries) if high is None else bisect_right(self.entries, (high, float('inf')))
+        return sorted([crit_id for _, crit_id in self.entries[start:end]])
@@ -0,0 +1,73 @@
+import queue
+import threading
+import time
+
+
+class ConnectionPool:
+    def __init__(self, connect, size=4, max_idle=600):
+        """
+        A small pool of reusable database connections
+        :param connect: a function without arguments that opens a new connection
+        :param size: the maximum number of connections that can be checked out at the same time
+        :param max_idle: the number of seconds after which an idle connection is replaced by a fresh one
+        """
+        self.connect = connect
+        self.size = size
+        self.max_idle = max_idle
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def get(self):
+        self.slots.acquire()
+        try:
+            while True:
+                try:
+                    conn, last_used = self.idle.get_nowait()
+                except queue.Empty:
+                    return self.connect()
+                if time.time() - last_used > self.max_idle:
+                    self.close_connection(conn)
+                elif self.is_healthy(conn):
+                    return conn
+        except:
+            self.slots.release()
+            raise
+
+    def put(self, conn):
+        # Ends a transaction that is still open, so that the next user of the connection doesn't read from its
+        # snapshot. Whatever had to be kept was committed already.
+        try:
+            conn.rollback()
+        except Exception:
+            self.discard(conn)
+            return
+        self.idle.put((conn, time.time()))
+        self.slots.release()
+
+    def discard(self, conn):
+        self.close_connection(conn)
+        self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self.close_connection(conn)
+
+    @staticmethod
+    def is_healthy(conn):
+        try:
+            conn.ping(reconnect=True)
+        except Exception:
+            ConnectionPool.close_connection(conn)
+            return False
+        return True
+
+    @staticmethod
+    def close_connection(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
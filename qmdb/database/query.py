@@ -0,0 +1,34 @@
+import re
+
+PATH_PATTERN = re.compile(r"""^(\w+)((?:\[(?:'[^']*'|"[^"]*"|\d+)\])*)$""")
+KEY_PATTERN = re.compile(r"""\[(?:'([^']*)'|"([^"]*)"|(\d+))\]""")
+
+
+def parse_path(path):
+    """
+    Splits an expression such as "my_ratings['tijl']['pred_score']" into the attribute and the keys to look up.
+    Nothing is evaluated, so only attribute names and string or integer keys are allowed.
+    :return: a list with the attribute name followed by the keys
+    """
+    m = PATH_PATTERN.match(path.replace(' ', ''))
+    if m is None:
+        raise ValueError("Can't parse the expression {}".format(path))
+    keys = [int(k[2]) if k[2] else (k[0] if k[1] == '' else k[1]) for k in KEY_PATTERN.findall(m.group(2))]
+    return [m.group(1)] + keys
+
+
+def make_getter(path):
+    """
+    :return: a function that gets the value of a path from a movie, or None if any part of it is missing
+    """
+    attribute, *keys = parse_path(path)
+
+    def getter(movie):
+        value = getattr(movie, attribute, None)
+        for key in keys:
+            try:
+                value = value[key]
+            except (KeyError, IndexError, TypeError):
+                return None
+        return value
+    return getter
@@ -0,0 +1,209 @@
+import os
+import sqlite3
+from datetime import datetime
+
+from qmdb.database.database import Database
+
+
+def dict_factory(cursor, row):
+    return {column[0]: row[i] for i, column in enumerate(cursor.description)}
+
+
+def adapt_datetime(d):
+    return d.isoformat(' ', 'microseconds')
+
+
+def convert_datetime(s):
+    return datetime.fromisoformat(s.decode())
+
+
+# Datetimes are stored as ISO strings, which sort chronologically, and parsed again based on the declared column type
+sqlite3.register_adapter(datetime, adapt_datetime)
+sqlite3.register_converter('datetime', convert_datetime)
+sqlite3.register_converter('timestamp', convert_datetime)
+
+
+class SQLiteCursor:
+    """
+    Wraps an sqlite3 cursor so that it accepts the same '%s' placeholders as the MySQL cursors
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, args=None):
+        return self.cursor.execute(sql.replace('%s', '?'), [] if args is None else args)
+
+    def executemany(self, sql, args):
+        return self.cursor.executemany(sql.replace('%s', '?'), args)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+class SQLiteDatabase(Database):
+    def __init__(self, path, from_scratch=False, sync_mode='diff', snapshot_path=None, load_profile='full',
+                 lazy_batch_size=1000):
+        """
+        A database stored in a single local file, which doesn't need a server
+        :param path: the path of the database file, or ':memory:' for a database that only lives in memory
+        :param from_scratch: whether to (re)create all tables
+        :param sync_mode: how child tables are stored, either 'diff' or 'replace'
+        :param snapshot_path: the path of a local snapshot file to speed up loading, if any
+        :param load_profile: 'full' to load everything, or 'core' to load the large text and detail attributes
+                             of the movies only when they are first accessed
+        :param lazy_batch_size: the number of movies for which a lazy attribute is loaded at once
+        """
+        self.path = path
+        self.schema = path if path == ':memory:' else os.path.abspath(path)
+        self.now_sql = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+        self.sqlite_conn = None
+        # A single connection is shared, so the child tables are always loaded one after the other
+        super().__init__(from_scratch=from_scratch, sync_mode=sync_mode, load_threads=1,
+                         snapshot_path=snapshot_path, load_profile=load_profile,
+                         lazy_batch_size=lazy_batch_size)
+
+    def get_connection(self):
+        if self.sqlite_conn is None:
+            self.sqlite_conn = sqlite3.connect(self.path, check_same_thread=False,
+                                               detect_types=sqlite3.PARSE_DECLTYPES)
+            self.sqlite_conn.row_factory = dict_factory
+            if self.path != ':memory:':
+                self.sqlite_conn.execute("pragma journal_mode = wal")
+                self.sqlite_conn.execute("pragma synchronous = normal")
+        return self.sqlite_conn
+
+    def release_connection(self, conn):
+        pass
+
+    def discard_connection(self, conn):
+        if self.path == ':memory:':
+            # An in-memory database only lives as long as its connection
+            return
+        conn.close()
+        self.sqlite_conn = None
+
+    def new_cursor(self, conn, streaming=False):
+        return SQLiteCursor(conn.cursor())
+
+    def disconnect(self):
+        if self.sqlite_conn is not None:
+            self.sqlite_conn.close()
+            self.sqlite_conn = None
+
+    def sqlite_column_type(self, column_type):
+        column_type = column_type.replace(' on update current_timestamp(6)', '')
+        return column_type.replace('current_timestamp(6)', '({})'.format(self.now_sql))
+
+    def create_table(self, table_name, column_info, primary_keys, indexes):
+        self.check_table_definition(primary_keys, indexes)
+        self.c.execute("drop table if exists {}".format(table_name))
+        print("Creating table {}.{}".format(self.schema, table_name))
+        sql = """
+            CREATE TABLE {} (
+                {},
+                PRIMARY KEY({})
+            )
+            """.format(table_name,
+                       ', '.join(["{} {}".format(k, self.sqlite_column_type(v)) for k, v in column_info.items()]),
+                       ', '.join(primary_keys))
+        self.c.execute(sql)
+        for columns in indexes:
+            self.create_index(table_name, columns)
+        for column, column_type in column_info.items():
+            if 'on update current_timestamp' in column_type:
+                self.create_on_update_trigger(table_name, column, primary_keys)
+
+    def create_on_update_trigger(self, table_name, column, primary_keys):
+        """
+        Emulates MySQL's 'on update current_timestamp' by setting the column whenever a row is updated
+        without setting it explicitly
+        """
+        self.c.execute("""
+            CREATE TRIGGER {0}_{1}_on_update AFTER UPDATE ON {0}
+               FOR EACH ROW WHEN NEW.{1} = OLD.{1}
+            BEGIN
+                UPDATE {0} SET {1} = {2} WHERE {3};
+            END
+            """.format(table_name, column, self.now_sql,
+                       ' and '.join(['{0} = NEW.{0}'.format(k) for k in primary_keys])))
+
+    def get_fingerprint(self):
+        """
+        Gets a cheap summary of the tables, which changes whenever rows are added, removed or updated
+        :return: a dictionary with the row count per table and the last modification of the movies,
+                 or None if it can't be determined
+        """
+        fingerprint = {}
+        try:
+            for tbl in self.get_snapshot_tables():
+                self.c.execute("select count(*) as n_rows from {}".format(tbl))
+                fingerprint[tbl] = self.c.fetchone()['n_rows']
+            self.c.execute("select max(last_modified) as last_modified from movies")
+            fingerprint['last_modified'] = self.c.fetchone()['last_modified']
+        except sqlite3.OperationalError:
+            return None
+        return fingerprint
+
+    def get_upsert_sql(self, tbl, columns):
+        updates = [k for k in columns if k not in self.primary_keys[tbl]]
+        sql = "insert into {} ({}) values ({}) on conflict ({}) do ".format(
+            tbl, ', '.join(columns), ', '.join(['%s' for _ in columns]), ', '.join(self.primary_keys[tbl]))
+        if len(updates) == 0:
+            return sql + "nothing"
+        return sql + "update set " + ', '.join(['{0} = excluded.{0}'.format(k) for k in updates])
+
+    def add_column(self, column_name, column_datatype, table_name='movies', after=None, first=False):
+        # SQLite always adds columns at the end, so 'after' and 'first' are ignored
+        sql = "alter table {} add column {} {}".format(table_name, column_name, self.sqlite_column_type(column_datatype))
+        try:
+            self.c.execute(sql)
+        except sqlite3.OperationalError as e:
+            if 'duplicate column name' not in str(e):
+                print(e)
+                raise Exception
+            else:
+                print("{} already in table {}".format(column_name, table_name))
+
+    def get_table_columns(self, table_name):
+        self.c.execute("pragma table_info({})".format(table_name))
+        return {d['name']: d['type'] for d in self.c.fetchall()}
+
+    def drop_index(self, table_name, index_name):
+        self.c.execute("drop index {}".format(index_name))
+
+    def get_table_indexes(self, table_name):
+        self.c.execute("select name from sqlite_master where type = 'index' and tbl_name = %s and sql is not null",
+                       [table_name])
+        indexes = {}
+        for index_name in [row['name'] for row in self.c.fetchall()]:
+            self.c.execute("pragma index_info({})".format(index_name))
+            indexes[index_name] = [row['name'] for row in sorted(self.c.fetchall(), key=lambda x: x['seqno'])]
+        return indexes
+
+    def change_column_type(self, table_name, column, column_type):
+        # SQLite can't change the type of a column, so the whole table is rebuilt
+        self.rebuild_table(table_name)
+
+    def rebuild_table(self, table_name):
+        """
+        Recreates a table with its desired columns, indexes and triggers, keeping the data of the columns that exist
+        """
+        columns = [k for k in self.get_table_columns(table_name) if k in getattr(self, 'columns_' + table_name)]
+        self.c.execute("select name from sqlite_master where type in ('index', 'trigger') and tbl_name = %s "
+                       "and sql is not null", [table_name])
+        for row in self.c.fetchall():
+            self.c.execute("drop {} {}".format('trigger' if row['name'].endswith('_on_update') else 'index',
+                                               row['name']))
+        self.c.execute("alter table {0} rename to {0}_old".format(table_name))
+        self.initialize(tbls=[table_name])
+        self.c.execute("insert into {0} ({1}) select {1} from {0}_old".format(table_name, ', '.join(columns)))
+        self.c.execute("drop table {}_old".format(table_name))
@@ -1,5 +1,4 @@
 import re
-import time
 
 import arrow
 import requests
@@ -8,15 +7,19 @@ from requests import ConnectionError
 
 from qmdb.config import config
 from qmdb.interfaces.interfaces import Scraper
+from qmdb.interfaces.ratelimiter import rate_limiter
 
 banned_movies = {154: 'Apocalypse Now Redux',
                  1011: "The Exorcist: The Version You've Never Seen"}
 
 
 class CritickerScraper(Scraper):
-    def __init__(self, config=config.criticker, user='tijl'):
+    host = 'www.criticker.com'
+
+    def __init__(self, config=config.criticker, user='tijl', rate_limiter=rate_limiter):
         self.user = user
         self.cookies = config[user]
+        self.rate_limiter = rate_limiter
 
     def refresh_movie(self, movie):
         super().refresh_movie(movie)
@@ -28,6 +31,7 @@ class CritickerScraper(Scraper):
             return None
 
     def get_movie_info(self, crit_url):
+        self.rate_limiter.acquire(self.host)
         try:
             r = requests.get(crit_url, cookies=self.cookies)
         except ConnectionError:
@@ -136,9 +140,9 @@ class CritickerScraper(Scraper):
         return movie_info
 
     def get_movie_list_html(self, url):
+        self.rate_limiter.acquire(self.host)
         try:
             r = requests.get(url, cookies=self.cookies)
-            time.sleep(1)
         except ConnectionError:
             print("Could not connect to Criticker.")
             return None
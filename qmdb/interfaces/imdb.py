@@ -6,11 +6,16 @@ from imdb import IMDb, utils
 import locale
 
 from qmdb.interfaces.interfaces import Scraper
+from qmdb.interfaces.ratelimiter import rate_limiter
+from qmdb.movie.persons import intern_strings, person_registry
 
 
 class IMDBScraper(Scraper):
-    def __init__(self):
+    host = 'www.imdb.com'
+
+    def __init__(self, rate_limiter=rate_limiter):
         self.ia = IMDb()
+        self.rate_limiter = rate_limiter
 
     def refresh_movie(self, movie, infoset='main'):
         super().refresh_movie(movie)
@@ -19,6 +24,8 @@ class IMDBScraper(Scraper):
             infoset = [infoset]
         for info in infoset:
             get_info = getattr(self, 'process_' + info + '_info')
+            # Every infoset is a separate page on IMDb
+            self.rate_limiter.acquire(self.host)
             movie_info = get_info(imdbid)
             if isinstance(movie_info, dict):
                 movie.update_from_dict(movie_info)
@@ -27,18 +34,23 @@ class IMDBScraper(Scraper):
     @staticmethod
     def person_to_dict(person):
         try:
-            person_dict = {'canonical_name': utils.canonicalName(person.data['name']),
-                           'name': utils.normalizeName(person.data['name']),
-                           'person_id': int(person.personID)}
+            person_dict = person_registry.get(int(person.personID), utils.normalizeName(person.data['name']),
+                                              utils.canonicalName(person.data['name']))
         except:
             person_dict = None
         return person_dict
 
     @staticmethod
     def remove_duplicate_dicts(l):
-        list_of_tuples = [tuple(d.items()) for d in l]
-        list_of_tuples = sorted(set(list_of_tuples), key=list_of_tuples.index)
-        return [dict(t) for t in list_of_tuples]
+        # The first occurrences themselves are kept, so that shared person dictionaries stay shared
+        seen = set()
+        unique = []
+        for d in l:
+            t = tuple(d.items())
+            if t not in seen:
+                seen.add(t)
+                unique.append(d)
+        return unique
 
     def process_main_info(self, imdbid):
         try:
@@ -65,15 +77,16 @@ class IMDBScraper(Scraper):
             info['writer'] = [self.person_to_dict(person) for person in writers]
             info['writer'] = [e for e in info['writer'] if e is not None]
             info['writer'] = self.remove_duplicate_dicts(info['writer'])
-        info['genres'] = None if main_info.get('genres') is None else sorted(list(set(main_info.get('genres'))))
+        info['genres'] = None if main_info.get('genres') is None \
+            else intern_strings(sorted(list(set(main_info.get('genres')))))
         runtimes = main_info.get('runtimes')
         if runtimes is not None:
             info['runtime'] = int(round(np.median([int(runtime) for runtime in main_info['runtimes']])))
-        info['countries'] = None if main_info.get('countries') is None else main_info.get('countries')
+        info['countries'] = intern_strings(main_info.get('countries'))
         info['imdb_rating'] = main_info.get('rating')
         info['imdb_votes'] = self.parse_imdb_votes(main_info.get('votes'))
         info['plot_storyline'] = main_info.get('plot outline')
-        info['languages'] = None if main_info.get('languages') is None else main_info.get('languages')
+        info['languages'] = intern_strings(main_info.get('languages'))
         info['imdb_main_updated'] = arrow.now()
         return info
 
@@ -218,7 +231,7 @@ class IMDBScraper(Scraper):
             return None
         info = dict()
         try:
-            info['keywords'] = sorted(list(set(keywords_info['keywords'])))
+            info['keywords'] = intern_strings(sorted(list(set(keywords_info['keywords']))))
         except KeyError:
             info['keywords'] = None
         info['imdb_keywords_updated'] = arrow.now()
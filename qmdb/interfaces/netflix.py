@@ -1,15 +1,18 @@
 import copy
-from datetime import timedelta
 
 import arrow
 import requests
 from bs4 import BeautifulSoup
 
 from qmdb.config import config
+from qmdb.interfaces.ratelimiter import rate_limiter
 
 
 class NetflixScraper:
-    def __init__(self, db, conf=config.netflix):
+    host = 'www.netflix.com'
+    unogs_host = 'unogs-unogs-v1.p.mashape.com'
+
+    def __init__(self, db, conf=config.netflix, rate_limiter=rate_limiter):
         self.db = db
         self.email = conf['email']
         self.password = conf['password']
@@ -23,14 +26,10 @@ class NetflixScraper:
                         'Referer': 'https://www.netflix.com'}
         self.session = requests.Session()
         self.authURL = None
-        self.unogs_last_suspension = self.db.unogs_suspension
-        if self.unogs_last_suspension is not None \
-                and arrow.now() - self.unogs_last_suspension <= timedelta(hours=18):
-            self.unogs_requests_remaining = 0
-        else:
-            self.unogs_requests_remaining = None
+        self.rate_limiter = rate_limiter
 
     def get_authurl(self):
+        self.rate_limiter.acquire(self.host)
         r = self.session.get("https://www.netflix.com/nl-en/login")
         soup = BeautifulSoup(r.text, "lxml")
         self.authURL = soup.find("input", attrs={'name': 'authURL'}).attrs['value']
@@ -52,14 +51,13 @@ class NetflixScraper:
         pass
 
     def do_unogs_request(self, url):
-        if self.unogs_requests_remaining is not None and self.unogs_requests_remaining < 1:
+        # Once the daily quota has run out, waiting for it would hold up everything else
+        if self.rate_limiter.is_suspended(self.unogs_host):
             raise NoUnogsRequestsRemaining
+        self.rate_limiter.acquire(self.unogs_host)
         r = requests.get(url, headers={"X-Mashape-Key": self.mashapekey, "Accept": "application/json"})
-        self.unogs_requests_remaining = int(r.headers._store['x-ratelimit-requests-remaining'][1])
-        if self.unogs_requests_remaining == 0:
-            self.db.unogs_suspension = arrow.now()
-            self.unogs_last_suspension = self.db.unogs_suspension
-            self.db.set_unogs_suspension()
+        if int(r.headers._store['x-ratelimit-requests-remaining'][1]) == 0:
+            self.rate_limiter.suspend(self.unogs_host, hours=18)
             raise NoUnogsRequestsRemaining
         return r.json()
 
@@ -101,7 +99,13 @@ class NetflixScraper:
                 'unogs_updated': arrow.now()}
 
     def get_critid_from_imdbid(self, imdbid):
-        return self.db.imdbid_to_critid.get(imdbid)
+        crit_ids = self.db.get_crit_ids('imdbid', imdbid)
+        if len(crit_ids) == 0:
+            return None
+        elif len(crit_ids) == 1:
+            return crit_ids.pop()
+        else:
+            return crit_ids
 
     def get_movies_for_genre_page(self, genreid, country_code=67, pagenr=1):
         rjson = self.do_unogs_request(("https://unogs-unogs-v1.p.mashape.com/aaapi.cgi?q={{query}}-!1800,2050-!0,5-!0,10-!{}-!Any-"
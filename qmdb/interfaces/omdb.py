@@ -5,9 +5,14 @@ import requests
 from requests import ConnectionError
 
 from qmdb.interfaces.interfaces import Scraper
+from qmdb.interfaces.ratelimiter import rate_limiter
 
 
 class OMDBScraper(Scraper):
+    host = 'www.omdbapi.com'
+
+    def __init__(self, rate_limiter=rate_limiter):
+        self.rate_limiter = rate_limiter
 
     def refresh_movie(self, movie):
         super().refresh_movie(movie)
@@ -20,13 +25,13 @@ class OMDBScraper(Scraper):
             movie.update_from_dict(movie_info)
         return movie
 
-    @staticmethod
-    def imdbid_to_rturl(imdbid, apikey='de76d779'):
+    def imdbid_to_rturl(self, imdbid, apikey='de76d779'):
         if imdbid is None:
             print("No IMDB id known for this movie. So I can't get a Rotten Tomatoes URL for it.")
             raise InvalidIMDbIdError
         imdbid_str = str(imdbid).zfill(7)
         omdb_url = 'http://www.omdbapi.com/?i=tt' + imdbid_str + '&tomatoes=true&apikey={}'.format(apikey)
+        self.rate_limiter.acquire(self.host)
         try:
             r = requests.get(omdb_url)
             jsonized = json.loads(r.text)
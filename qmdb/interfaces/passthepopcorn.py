@@ -6,17 +6,22 @@ from requests import ConnectionError
 
 from qmdb.config import config
 from qmdb.interfaces.interfaces import Scraper
+from qmdb.interfaces.ratelimiter import rate_limiter
 
 
 class PassThePopcornScraper(Scraper):
-    def __init__(self, conf=config.passthepopcorn):
+    host = 'passthepopcorn.me'
+
+    def __init__(self, conf=config.passthepopcorn, rate_limiter=rate_limiter):
         self.username = conf['username']
         self.password = conf['password']
         self.passkey = conf['passkey']
         self.session = requests.Session()
         self.session_started = False
+        self.rate_limiter = rate_limiter
 
     def create_session(self):
+        self.rate_limiter.acquire(self.host)
         self.session.post("https://passthepopcorn.me/ajax.php?action=login",
                           data={"username": self.username, "password": self.password, "passkey": self.passkey,
                                 "keeplogged": "0", "login": "Login"}, allow_redirects=False)
@@ -39,6 +44,7 @@ class PassThePopcornScraper(Scraper):
 
     def get_ptp_request(self, url):
         self.session_check()
+        self.rate_limiter.acquire(self.host)
         r = self.session.get(url)
         if r.status_code != 200:
             raise Exception("ERROR {}. Something went wrong with the request to PassThePopcorn".format(r.status_code))
@@ -0,0 +1,162 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timezone
+
+
+# Per external host, the number of requests per hour and the number of requests that may be done in a burst.
+# Criticker keeps the pace of a request per second that its list crawls always had.
+DEFAULT_LIMITS = {'www.criticker.com': (3600, 20),
+                  'www.omdbapi.com': (40, 2),
+                  'www.imdb.com': (800, 40),
+                  'passthepopcorn.me': (400, 20),
+                  'www.netflix.com': (400, 20),
+                  'unogs-unogs-v1.p.mashape.com': (100, 5)}
+
+
+class TokenBucket:
+    def __init__(self, per_hour, capacity, tokens=None, updated=None, suspended_until=None):
+        """
+        Tokens are added at a steady rate until the bucket is full, and every request takes one.
+        Requests can then be done at the average rate, with bursts of at most the capacity.
+        :param per_hour: the number of tokens that are added per hour
+        :param capacity: the maximum number of tokens
+        :param tokens: the number of tokens at the time it was updated, or None for a full bucket
+        :param updated: the timestamp at which the number of tokens was last brought up to date
+        :param suspended_until: a timestamp before which no tokens are given out at all
+        """
+        self.rate = per_hour / 3600
+        self.capacity = capacity
+        self.tokens = capacity if tokens is None else min(tokens, capacity)
+        self.updated = time.time() if updated is None else updated
+        self.suspended_until = suspended_until
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def get_wait_time(self, now):
+        """
+        :return: the number of seconds until a token can be taken
+        """
+        self.refill(now)
+        wait_time = max(0, (1 - self.tokens) / self.rate)
+        if self.suspended_until is not None:
+            wait_time = max(wait_time, self.suspended_until - now)
+        return wait_time
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+class RateLimiter:
+    def __init__(self, limits=None, store_interval=60):
+        """
+        Keeps a token bucket per external host, which all scrapers and threads that use the host share.
+        Once a database is attached, the buckets are stored every so often and at exit, so that a restart
+        continues with the tokens that were left instead of a full bucket.
+        :param limits: per host, the number of requests per hour and the capacity, to use instead of DEFAULT_LIMITS
+        :param store_interval: the minimum number of seconds between two writes of the buckets to the database
+        """
+        self.limits = dict(DEFAULT_LIMITS)
+        if limits is not None:
+            self.limits.update(limits)
+        self.store_interval = store_interval
+        self.buckets = {}
+        self.db = None
+        # The hosts of which the buckets changed since they were last stored
+        self.changed_hosts = set()
+        self.last_stored = time.time()
+        self.lock = threading.Lock()
+
+    def attach(self, db):
+        """
+        Continues with the buckets that are stored in a database, and stores them there from now on
+        """
+        with self.lock:
+            if self.db is None:
+                atexit.register(self.store)
+            self.db = db
+            for row in db.load_rate_limits():
+                if row['host'] in self.limits:
+                    per_hour, capacity = self.limits[row['host']]
+                    self.buckets[row['host']] = TokenBucket(per_hour, capacity, tokens=row['tokens'],
+                                                            updated=to_timestamp(row['updated']),
+                                                            suspended_until=to_timestamp(row['suspended_until']))
+
+    def get_bucket(self, host):
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            per_hour, capacity = self.limits[host]
+            bucket = TokenBucket(per_hour, capacity)
+            self.buckets[host] = bucket
+        return bucket
+
+    def acquire(self, host):
+        """
+        Takes a token for a request to a host, waiting until one is available
+        """
+        while True:
+            with self.lock:
+                bucket = self.get_bucket(host)
+                now = time.time()
+                wait_time = bucket.get_wait_time(now)
+                if wait_time <= 0:
+                    bucket.take(now)
+                    self.changed_hosts.add(host)
+                    store = now - self.last_stored >= self.store_interval
+                    break
+            time.sleep(wait_time)
+        if store:
+            self.store()
+
+    def suspend(self, host, hours):
+        """
+        Stops giving out tokens for a host for a while, e.g. when its quota has run out
+        """
+        with self.lock:
+            bucket = self.get_bucket(host)
+            bucket.suspended_until = time.time() + hours * 3600
+            self.changed_hosts.add(host)
+        self.store()
+
+    def is_suspended(self, host):
+        with self.lock:
+            bucket = self.get_bucket(host)
+            return bucket.suspended_until is not None and bucket.suspended_until > time.time()
+
+    def store(self):
+        """
+        Writes the buckets that changed to the database. The write happens outside the lock,
+        so that requests to other hosts don't wait for it.
+        """
+        with self.lock:
+            if self.db is None or len(self.changed_hosts) == 0:
+                return
+            db = self.db
+            rows = [(host, self.buckets[host].tokens, to_datetime(self.buckets[host].updated),
+                     to_datetime(self.buckets[host].suspended_until)) for host in sorted(self.changed_hosts)]
+            self.changed_hosts = set()
+            self.last_stored = time.time()
+        try:
+            db.set_rate_limits(rows)
+        except Exception:
+            with self.lock:
+                self.changed_hosts.update([row[0] for row in rows])
+            raise
+
+
+def to_timestamp(dt):
+    """
+    Converts a naive datetime in UTC, as it is stored in the database, to a timestamp
+    """
+    return None if dt is None else dt.replace(tzinfo=timezone.utc).timestamp()
+
+
+def to_datetime(ts):
+    return None if ts is None else datetime.fromtimestamp(ts, tz=timezone.utc).replace(tzinfo=None)
+
+
+rate_limiter = RateLimiter()
@@ -2,17 +2,24 @@ from qmdb.interfaces.criticker import CritickerScraper
 from qmdb.interfaces.omdb import OMDBScraper
 from qmdb.interfaces.imdb import IMDBScraper
 from qmdb.interfaces.passthepopcorn import PassThePopcornScraper
-from operator import itemgetter
+import heapq
+import threading
 import numpy as np
 import arrow
 import time
+from datetime import timezone
 from qmdb.movie.utils import humanized_time
 import re
 from qmdb.movie.movie import Movie
 
 
 class Updater(object):
-    def __init__(self, **kwargs):
+    def __init__(self, seed=None, **kwargs):
+        """
+        :param seed: a seed for the random jitter of the schedule, to make it reproducible
+        :param kwargs: multipliers of the update periods, see self.multipliers
+        """
+        self.rng = np.random.default_rng(seed)
         self.sources = ['criticker', 'omdb', 'imdb_main', 'imdb_release', 'imdb_metacritic', 'imdb_keywords',
                         'imdb_taglines', 'imdb_vote_details', 'imdb_plot', 'ptp']
         self.multipliers = {'base_multiplier': 1,
@@ -41,48 +48,215 @@ class Updater(object):
         self.years = None
         self.crit_pop = None
         self.earliest_date_added = None
-        self.max_connections_per_hour = {'criticker': 400,
-                                         'omdb': 40,
-                                         'imdb': 800,
-                                         'ptp': 400}
+        # The sources of a group share a host, whose rate limit the scrapers take care of
+        self.source_groups = ['criticker', 'omdb', 'imdb', 'ptp']
+        # Per source group, a heap of (next update timestamp, crit_id, source)
+        self.queues = None
+        self.scheduled_crit_ids = set()
+        self.weibull_lambda = None
+        # The number of seconds after which a source that couldn't be refreshed is tried again,
+        # unless its update period is longer
+        self.retry_delay = 24 * 3600
+        # Guards the queues when several workers use them, and the movies that a worker is refreshing
+        self.lock = threading.RLock()
+        self.busy_crit_ids = set()
 
     def update_movies(self, db, n=None, weibull_lambda=1.5):
-        self.get_movies_stats(db)
-        updates = self.get_all_next_updates(db, weibull_lambda=weibull_lambda)
-        crit_updates = self.get_source_update_sequence(updates, 'criticker')
-        omdb_updates = self.get_source_update_sequence(updates, 'omdb')
-        imdb_updates = self.get_source_update_sequence(updates, 'imdb')
-        ptp_updates = self.get_source_update_sequence(updates, 'ptp')
-        sorted_seq = sorted(crit_updates + omdb_updates + imdb_updates + ptp_updates, key=itemgetter('next_update'))
-        if n is not None:
-            sources_to_update = sorted_seq[:n]
+        """
+        Refreshes movie information from the sources, in the order of a schedule that is built once
+        and in which only the refreshed movie and source are rescheduled afterwards
+        :param n: the number of refreshes to do, waiting for them to be due if necessary,
+                  or None to do the ones that are due now
+        """
+        if self.queues is None or weibull_lambda != self.weibull_lambda:
+            self.build_queues(db, weibull_lambda=weibull_lambda)
         else:
-            sources_to_update = sorted_seq
-        for i, source_to_update in enumerate(sources_to_update):
-            time_to_sleep = max(1, (source_to_update['next_update'] - arrow.now()).total_seconds())
-            last_updated = getattr(db.movies[source_to_update['crit_id']], source_to_update['source'] + '_updated')
-            crit_popularity = db.movies[source_to_update['crit_id']].crit_popularity
-            if crit_popularity is None:
-                crit_popularity = 5
-            print("{}: Updating {} info for '{}' ({}, popularity {:.1f}) {}. Last updated {}.".format(
-                arrow.now().format('HH:mm:ss'), source_to_update['source'], db.movies[source_to_update['crit_id']].title,
-                db.movies[source_to_update['crit_id']].year,
-                crit_popularity,
-                arrow.now().shift(seconds=time_to_sleep).humanize(),
-                humanized_time(last_updated)))
+            self.schedule_new_movies(db)
+        # Updates that become due while this pass runs, such as retries, are left for the next pass
+        until = time.time() if n is None else None
+        i = 0
+        while n is None or i < n:
+            source_to_update = self.pop_next_update(until=until)
+            if source_to_update is None:
+                break
+            i += 1
+            if source_to_update['crit_id'] not in db.movies:
+                continue
+            time_to_sleep = max(0, (source_to_update['next_update'] - arrow.now()).total_seconds())
+            self.print_update(db, source_to_update, time_to_sleep)
             time.sleep(time_to_sleep)
-            self.update_source(db, source_to_update)
+            self.refresh_source(db, source_to_update)
         return
 
+    def update_movies_concurrently(self, db, duration, weibull_lambda=1.5):
+        """
+        Refreshes movie information with one worker thread per source group, so that a slow source doesn't hold up
+        the others and each one can be used at its own rate
+        :param duration: the number of seconds during which updates that become due are done
+        """
+        if self.queues is None or weibull_lambda != self.weibull_lambda:
+            self.build_queues(db, weibull_lambda=weibull_lambda)
+        else:
+            self.schedule_new_movies(db)
+        until = time.time() + duration
+        workers = [threading.Thread(target=self.run_worker, args=(db, group, until), name='updater-' + group)
+                   for group in self.queues]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def run_worker(self, db, group, until):
+        """
+        Works through the queue of one source group, until the next update isn't due before a certain time
+        :param until: a timestamp
+        """
+        while True:
+            with self.lock:
+                queue = self.queues[group]
+                if len(queue) == 0 or queue[0][0] > until:
+                    return
+                source_to_update = self.pop_next_update(groups=[group])
+                crit_id = source_to_update['crit_id']
+                if crit_id not in db.movies:
+                    continue
+                if crit_id in self.busy_crit_ids:
+                    # Another worker is refreshing this movie, so this source is done a bit later
+                    heapq.heappush(queue, (time.time() + 60, crit_id, source_to_update['source']))
+                    continue
+                self.busy_crit_ids.add(crit_id)
+            try:
+                time_to_sleep = max(0, (source_to_update['next_update'] - arrow.now()).total_seconds())
+                self.print_update(db, source_to_update, time_to_sleep)
+                time.sleep(time_to_sleep)
+                self.refresh_source(db, source_to_update)
+            except Exception as e:
+                print("Could not update {} info for {}: {}".format(source_to_update['source'], crit_id, e))
+            finally:
+                with self.lock:
+                    self.busy_crit_ids.discard(crit_id)
+
+    @staticmethod
+    def print_update(db, source_to_update, time_to_sleep):
+        movie = db.movies[source_to_update['crit_id']]
+        last_updated = getattr(movie, source_to_update['source'] + '_updated')
+        crit_popularity = 5 if movie.crit_popularity is None else movie.crit_popularity
+        print("{}: Updating {} info for '{}' ({}, popularity {:.1f}) {}. Last updated {}.".format(
+            arrow.now().format('HH:mm:ss'), source_to_update['source'], movie.title, movie.year, crit_popularity,
+            arrow.now().shift(seconds=time_to_sleep).humanize(), humanized_time(last_updated)))
+
+    def refresh_source(self, db, source_to_update):
+        """
+        Refreshes one source of a movie and reschedules it
+        """
+        source = source_to_update['source']
+        movie = db.movies[source_to_update['crit_id']]
+        had_imdbid = movie.imdbid is not None
+        last_updated = getattr(movie, source + '_updated')
+        try:
+            self.update_source(db, source_to_update)
+        except Exception:
+            # The update was taken from its queue already, and would otherwise be lost until the queues are rebuilt
+            self.schedule(db, db.movies[source_to_update['crit_id']], sources=[source], retry=True)
+            raise
+        movie = db.movies[source_to_update['crit_id']]
+        if getattr(movie, source + '_updated') == last_updated:
+            # The source didn't give anything, e.g. because it doesn't know the movie. Its next update would
+            # still be due now, so trying again right away would only give the same result.
+            self.schedule(db, movie, sources=[source], retry=True)
+        elif had_imdbid or movie.imdbid is None:
+            self.schedule(db, movie, sources=[source])
+        else:
+            # The other sources can only be updated once the IMDb id is known
+            self.schedule(db, movie)
+
+    def get_source_group(self, source):
+        for group in self.source_groups:
+            if source.startswith(group):
+                return group
+
+    def build_queues(self, db, weibull_lambda=1.5):
+        """
+        Fills the queues from the schedule that is stored in the database, so that a restart continues where it
+        stopped, and only calculates and stores the next updates of the movies and sources that aren't scheduled yet
+        """
+        self.weibull_lambda = weibull_lambda
+        self.get_movies_stats(db)
+        self.queues = {group: [] for group in self.source_groups}
+        scheduled = {source: [] for source in self.sources}
+        for row in db.load_schedule():
+            if row['crit_id'] in db.movies and row['source'] in scheduled:
+                self.queues[self.get_source_group(row['source'])].append(
+                    (row['next_update'].replace(tzinfo=timezone.utc).timestamp(), row['crit_id'], row['source']))
+                scheduled[row['source']].append(row['crit_id'])
+        updates = self.calculate_all_next_updates(db, weibull_lambda=weibull_lambda, scheduled=scheduled)
+        for source in self.sources:
+            rows = updates['source'] == source
+            self.queues[self.get_source_group(source)] += zip(updates['next_update'][rows].tolist(),
+                                                              updates['crit_id'][rows].tolist(),
+                                                              [source] * int(np.sum(rows)))
+        if len(updates['crit_id']) > 0:
+            next_updates = (updates['next_update'] * 1e6).astype('datetime64[us]').tolist()
+            db.set_schedule(zip(updates['crit_id'].tolist(), updates['source'].tolist(), next_updates,
+                                updates['update_period'].tolist()))
+        self.scheduled_crit_ids = set(db.column_store.crit_ids.tolist())
+        for queue in self.queues.values():
+            heapq.heapify(queue)
+
+    def schedule_new_movies(self, db):
+        for crit_id in db.movies.keys() - self.scheduled_crit_ids:
+            self.schedule(db, db.movies[crit_id])
+
+    def schedule(self, db, movie, sources=None, retry=False):
+        """
+        Adds the next updates of a movie to the queues, but not before now, so that a source that
+        wasn't updated for a long time doesn't get ahead of the others that are due
+        :param retry: whether the sources couldn't be refreshed, so that they are tried again after their update
+                      period, or after retry_delay if that is longer
+        """
+        now = time.time()
+        entries = []
+        with self.lock:
+            for u in self.calculate_next_updates(movie, weibull_lambda=self.weibull_lambda, sources=sources):
+                if retry:
+                    next_update = now + max(self.retry_delay, u['actual_update_period'] * 7 * 24 * 3600)
+                else:
+                    next_update = max(now, u['next_update'].float_timestamp)
+                heapq.heappush(self.queues[self.get_source_group(u['source'])],
+                               (next_update, u['crit_id'], u['source']))
+                entries.append((u['crit_id'], u['source'], arrow.get(next_update), u['actual_update_period']))
+            self.scheduled_crit_ids.add(movie.crit_id)
+        db.set_schedule(entries)
+
+    def pop_next_update(self, until=None, groups=None):
+        """
+        Takes the update that is due first. Waiting for the rate limit of its host is left to the scraper.
+        :param until: a timestamp after which updates are left in the queues, or None to take them anyway
+        :param groups: the source groups to take the update from, or None for all of them
+        :return: a dictionary with the source, crit_id and time of the update, or None if there is none
+        """
+        best_group = None
+        for group in (self.queues if groups is None else groups):
+            queue = self.queues[group]
+            if len(queue) == 0 or (until is not None and queue[0][0] > until):
+                continue
+            if best_group is None or queue[0] < self.queues[best_group][0]:
+                best_group = group
+        if best_group is None:
+            return None
+        next_update, crit_id, source = heapq.heappop(self.queues[best_group])
+        return {'source': source, 'crit_id': crit_id, 'next_update': arrow.get(next_update)}
+
     def get_movies_stats(self, db):
-        years_numbers = [db.movies[crit_id].get_floating_release_year() for crit_id in db.movies]
+        columns = db.column_store
+        years_numbers = columns.floating_release_years()
+        years_numbers = years_numbers[~np.isnan(years_numbers)]
         years = {'min': np.min(years_numbers),
                  'median': np.median(years_numbers),
                  'max': np.max(years_numbers)}
         years['b_parameter'] = self.b_parameter(years['max'] - years['median'], years['max'] - years['min'])
         years['a_parameter'] = self.a_parameter(years['max'] - years['median'], years['b_parameter'])
-        crit_pop_nrs = [db.movies[crit_id].crit_popularity for crit_id in db.movies
-                        if db.movies[crit_id].crit_popularity is not None]
+        crit_pop_nrs = columns.values('crit_popularity')
         crit_pop = {'min': np.min(crit_pop_nrs),
                     'median': np.median(crit_pop_nrs),
                     'max': np.max(crit_pop_nrs)}
@@ -92,7 +266,7 @@ class Updater(object):
                                                    crit_pop['b_parameter'])
         self.years = years
         self.crit_pop = crit_pop
-        self.earliest_date_added = np.min([db.movies[crit_id].date_added for crit_id in db.movies])
+        self.earliest_date_added = arrow.get(np.min(columns.values('date_added')).item())
 
     @staticmethod
     def b_parameter(median_feature, max_feature, median_period=6, max_period=36):
@@ -102,25 +276,17 @@ class Updater(object):
     def a_parameter(median_feature, b_parameter, median_period=8):
         return np.log(median_period)/np.power(median_feature, b_parameter)
 
-    def get_all_next_updates(self, db, weibull_lambda=1.5):
-        seq = []
-        for crit_id, movie in db.movies.items():
-            updates = self.calculate_next_updates(movie, weibull_lambda=weibull_lambda)
-            seq += list(updates)
-        now = arrow.now()
-        seq = [u for u in seq if u['next_update'] <= now]
-        return seq
-
-    def calculate_next_updates(self, movie, weibull_lambda=1.5):
-        year_period_score = self.calculate_period_score(self.years['max'] - movie.year, self.years)
+    def calculate_next_updates(self, movie, weibull_lambda=1.5, sources=None):
+        year = self.years['median'] if movie.year is None else movie.year
+        year_period_score = self.calculate_period_score(self.years['max'] - year, self.years)
         crit_popularity = self.crit_pop['median'] if movie.crit_popularity is None else movie.crit_popularity
         crit_pop_period_score = self.calculate_period_score(self.crit_pop['max'] - crit_popularity, self.crit_pop)
         base_update_period = self.calculate_update_period(year_period_score, crit_pop_period_score)
 
         update_periods = {}
-        for source in self.sources:
+        for source in (self.sources if sources is None else sources):
             if (source in ('omdb', 'ptp') or source.startswith('imdb')) and movie.imdbid is None:
-                break
+                continue
             update_periods[source] = dict()
             update_periods[source]['source'] = source
             update_periods[source]['crit_id'] = movie.crit_id
@@ -135,6 +301,44 @@ class Updater(object):
             update_periods[source]['actual_update_period'] = period
         return list(update_periods.values())
 
+    def calculate_all_next_updates(self, db, weibull_lambda=1.5, min_period=500, scheduled=None):
+        """
+        The vectorised counterpart of calculate_next_updates, for all movies and sources at once
+        :param scheduled: per source, the criticker ids of the movies that already have a next update, which are skipped
+        :return: a dictionary with arrays of the 'crit_id', 'source', 'next_update' (a timestamp in seconds)
+                 and 'update_period' (in weeks) of each update
+        """
+        columns = db.column_store
+        years = columns.column('year', fill=np.nan)
+        years = np.where(np.isnan(years), self.years['median'], years)
+        crit_popularity = columns.column('crit_popularity', fill=self.crit_pop['median'])
+        base_update_periods = self.calculate_update_period(
+            self.calculate_period_score(self.years['max'] - years, self.years),
+            self.calculate_period_score(self.crit_pop['max'] - crit_popularity, self.crit_pop))
+        has_imdbid = ~columns.nulls('imdbid')
+        epoch = np.datetime64('1970-01-01', 'us')
+        earliest_date_added = np.datetime64(self.earliest_date_added.to('UTC').naive, 'us')
+        updates = {'crit_id': [], 'source': [], 'next_update': [], 'update_period': []}
+        for source in self.sources:
+            if source in ('omdb', 'ptp') or source.startswith('imdb'):
+                rows = np.flatnonzero(has_imdbid)
+            else:
+                rows = np.arange(columns.size)
+            if scheduled is not None:
+                rows = rows[~np.isin(columns.crit_ids[rows], scheduled[source])]
+            never_updated = columns.nulls(source + '_updated')[rows]
+            periods = base_update_periods[rows] * np.where(never_updated,
+                                                           self.multipliers['multiplier_' + source + '_firsttime'],
+                                                           self.multipliers['multiplier_' + source])
+            weibull = self.rng.weibull(weibull_lambda, len(rows)) / np.power(np.log(2), 1 / weibull_lambda)
+            last_updated = np.where(never_updated, earliest_date_added, columns.column(source + '_updated')[rows])
+            shifts = np.minimum(periods * weibull, min_period) * 7 * 24 * 3600
+            updates['crit_id'].append(columns.crit_ids[rows])
+            updates['source'].append(np.full(len(rows), source, dtype=object))
+            updates['next_update'].append((last_updated - epoch) / np.timedelta64(1, 's') + shifts)
+            updates['update_period'].append(np.minimum(periods, min_period))
+        return {k: np.concatenate(v) for k, v in updates.items()}
+
     @staticmethod
     def calculate_period_score(feature, stats):
         return np.exp(stats['a_parameter']*np.power(feature, stats['b_parameter']))
@@ -148,7 +352,7 @@ class Updater(object):
         return period
 
     def calculate_next_update(self, date_updated, period, firsttime_period, weibull_lambda=1.5, min_period=500):
-        weibull = (np.random.weibull(weibull_lambda, 1) / np.power(np.log(2), 1 / weibull_lambda))[0]
+        weibull = (self.rng.weibull(weibull_lambda, 1) / np.power(np.log(2), 1 / weibull_lambda))[0]
         if date_updated is None:
             next_update = self.earliest_date_added.shift(weeks=min(firsttime_period * weibull, min_period))
             return next_update, min(firsttime_period, min_period)
@@ -156,20 +360,6 @@ class Updater(object):
             next_update = date_updated.shift(weeks=min(period * weibull, min_period))
             return next_update, min(period, min_period)
 
-    def get_source_update_sequence(self, all_updates, source):
-        updates = [u for u in all_updates if u['source'].startswith(source)]
-        sorted_updates = sorted(updates, key=itemgetter('next_update'))
-        if len(sorted_updates) > 0:
-            uph = min(len(sorted_updates), self.max_connections_per_hour[source])
-            print("Updates needed per hour for {}: {:.0f}".format(source, uph))
-            update_intervals = np.random.exponential(3600/uph, len(sorted_updates))
-            for i, u in enumerate(sorted_updates):
-                if i > 0:
-                    sorted_updates[i]['next_update'] = sorted_updates[i-1]['next_update'].shift(seconds=update_intervals[i])
-                else:
-                    sorted_updates[i]['next_update'] = arrow.now().shift(seconds=update_intervals[i])
-        return sorted_updates
-
     def update_source(self, db, source_to_update):
         movie = db.movies[source_to_update['crit_id']]
         if source_to_update['source'] == 'criticker':
@@ -4,11 +4,14 @@ from qmdb.interfaces.criticker import CritickerScraper
 from qmdb.interfaces.updater import Updater
 from qmdb.model.predictions import RatingModeler
 from qmdb.interfaces.netflix import NetflixScraper
-import time
+from qmdb.interfaces.ratelimiter import rate_limiter
 
 
 if __name__ == "__main__":
-    db = MySQLDatabase(from_scratch=False)
+    # The daemon doesn't need the plots, keywords, taglines and vote details, which are loaded when they're used
+    db = MySQLDatabase(from_scratch=False, load_profile='core')
+    # All scrapers share the rate limits, which continue where the previous run left them
+    rate_limiter.attach(db)
     omdb_scraper = OMDBScraper()
     crit_scraper = CritickerScraper(user='tijl')
     updater = Updater()
@@ -17,9 +20,7 @@ if __name__ == "__main__":
 
     while True:
         print("\nRefreshing movie information from Criticker, IMDb and OMDB\n")
-        time0 = time.time()
-        while time.time() - time0 <= 12*3600:
-            updater.update_movies(db, n=30, weibull_lambda=3)
+        updater.update_movies_concurrently(db, duration=12*3600, weibull_lambda=3)
         crit_scraper.get_movies(db, start_popularity=2)
         netflix_scraper.get_genre_ids()
         netflix_scraper.get_movies_for_genres()
@@ -47,17 +47,19 @@ class RatingModeler:
         self.cols_to_use = None
 
     def load_movies(self):
-        movies = pd.DataFrame([self.db.movie_to_dict_movies(self.db.movies[crit_id]) for crit_id in self.db.movies])
-        movies['release_date'] = movies.apply(lambda r: ifnull(r['dutch_release_date'],
-                                                               ifnull(r['original_release_date'],
-                                                                      arrow.get(str(ifnull(r['imdb_year'],
-                                                                                           ifnull(r['year'],
-                                                                                                  1900))) + '-01-01'))),
-                                              axis=1)
-        movies['years_since_release'] = movies['release_date'].apply(lambda r: (arrow.now() - r).days / 365.25)
-        cols = ['crit_id', 'imdbid', 'title', 'year', 'crit_rating', 'crit_votes', 'imdb_rating',
-                'imdb_votes', 'kind', 'metacritic_score', 'runtime', 'years_since_release']
-        movies = movies[cols].set_index('crit_id')
+        columns = self.db.column_store
+        cols = ['imdbid', 'title', 'year', 'crit_rating', 'crit_votes', 'imdb_rating', 'imdb_votes', 'kind',
+                'metacritic_score', 'runtime']
+        movies = pd.DataFrame({col: columns.column(col) if columns.dtypes[col] == object
+                               else columns.column(col, fill=np.nan) for col in cols},
+                              index=pd.Index(columns.crit_ids, name='crit_id'))
+        years = np.where(columns.nulls('imdb_year'), columns.column('year', fill=1900), columns.column('imdb_year'))
+        release_dates = (years - 1970).astype('datetime64[Y]').astype('datetime64[us]')
+        for col in ['original_release_date', 'dutch_release_date']:
+            release_dates = np.where(columns.nulls(col), release_dates, columns.column(col))
+        now = np.datetime64(arrow.utcnow().naive, 'us')
+        days_since_release = np.floor((now - release_dates) / np.timedelta64(1, 'D'))
+        movies['years_since_release'] = days_since_release / 365.25
         print("{} movies in this dataframe.".format(len(movies)))
         return movies
 
@@ -90,6 +92,7 @@ class RatingModeler:
 
     def load_data(self):
         print("Loading data to be used for training...")
+        self.db.refresh()
         movies_raw = self.load_movies()
         ratings = self.load_ratings()
         psis = self.load_psis()
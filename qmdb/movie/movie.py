@@ -1,9 +1,45 @@
 from qmdb.movie.utils import humanized_time
 import arrow
+from datetime import datetime
+from operator import attrgetter
+
+
+ATTRIBUTES = ('crit_id', 'crit_popularity', 'crit_url', 'title', 'year', 'imdbid', 'tomato_url', 'poster_url',
+              'trailer_url', 'crit_rating', 'crit_votes', 'imdb_title', 'imdb_year', 'kind', 'cast', 'director',
+              'writer', 'genres', 'runtime', 'countries', 'imdb_rating', 'imdb_votes', 'plot_summary',
+              'plot_storyline', 'languages', 'original_release_date', 'dutch_release_date', 'original_title',
+              'english_title', 'metacritic_score', 'keywords', 'taglines', 'vote_details', 'ptp_url',
+              'ptp_hd_available', 'netflix_id', 'netflix_rating', 'netflix_title', 'date_added',
+              'criticker_updated', 'imdb_main_updated', 'imdb_release_updated', 'imdb_metacritic_updated',
+              'imdb_keywords_updated', 'imdb_taglines_updated', 'imdb_vote_details_updated', 'imdb_plot_updated',
+              'omdb_updated', 'ptp_updated', 'netflix_updated', 'my_ratings')
+get_attributes = attrgetter(*ATTRIBUTES)
+# Large attributes that aren't needed for updating or modelling, which a database can load on first access instead
+LAZY_ATTRIBUTES = ('plot_summary', 'plot_storyline', 'keywords', 'taglines', 'vote_details')
+
+
+class NotLoaded(object):
+    def __repr__(self):
+        return 'NOT_LOADED'
+
+    def __reduce__(self):
+        return 'NOT_LOADED'
+
+
+NOT_LOADED = NotLoaded()
 
 
 class Movie(object):
+    # The lazy attributes are stored in slots with an underscore, behind a LazyAttribute with the plain name
+    __slots__ = tuple([name for name in ATTRIBUTES if name not in LAZY_ATTRIBUTES]) \
+        + tuple(['_' + name for name in LAZY_ATTRIBUTES]) + ('changed_attributes', 'loader')
+
     def __init__(self, movie_info):
+        self.set_defaults()
+        self.changed_attributes = set()
+        self.update_from_dict(movie_info)
+
+    def set_defaults(self):
         self.crit_id = None
         self.crit_popularity = None
         self.crit_url = None
@@ -55,7 +91,7 @@ class Movie(object):
         self.ptp_updated = None
         self.netflix_updated = None
         self.my_ratings = dict()
-        self.update_from_dict(movie_info)
+        self.loader = None
 
     def print(self):
         print("{} - {} ({}) - Criticker updated {} - OMDB updated {}".format(
@@ -67,77 +103,83 @@ class Movie(object):
         if self.crit_id is None and ('crit_id' not in movie_info or not isinstance(movie_info['crit_id'], int)):
             raise Exception("There is no valid criticker id listed in the movie info "
                             "and the movie object didn't already have one!")
-        self.crit_id = replace_if_not_none(movie_info.get('crit_id'), self.crit_id)
-        self.crit_popularity = replace_if_not_none(movie_info.get('crit_popularity'),
-                                                             self.crit_popularity)
-        self.crit_url = replace_if_not_none(movie_info.get('crit_url'), self.crit_url)
-        self.title = replace_if_not_none(movie_info.get('title'), self.title)
-        self.year = replace_if_not_none(movie_info.get('year'), self.year)
-        self.imdbid = replace_if_not_none(movie_info.get('imdbid'), self.imdbid)
-        self.tomato_url = replace_if_not_none(movie_info.get('tomato_url'), self.tomato_url)
-        self.poster_url = replace_if_not_none(movie_info.get('poster_url'), self.poster_url)
-        self.trailer_url = replace_if_not_none(movie_info.get('trailer_url'), self.trailer_url)
-        self.crit_rating = replace_if_not_none(movie_info.get('crit_rating'), self.crit_rating)
-        self.crit_votes = replace_if_not_none(movie_info.get('crit_votes'), self.crit_votes)
-        self.imdb_title = replace_if_not_none(movie_info.get('imdb_title'), self.imdb_title)
-        self.imdb_year = replace_if_not_none(movie_info.get('imdb_year'), self.imdb_year)
-        self.kind = replace_if_not_none(movie_info.get('kind'), self.kind)
-        self.cast = replace_if_not_none(movie_info.get('cast'), self.cast)
-        self.director = replace_if_not_none(movie_info.get('director'), self.director)
-        self.writer = replace_if_not_none(movie_info.get('writer'), self.writer)
-        self.genres = replace_if_not_none(movie_info.get('genres'), self.genres)
-        self.runtime = replace_if_not_none(movie_info.get('runtime'), self.runtime)
-        self.countries = replace_if_not_none(movie_info.get('countries'), self.countries)
-        self.imdb_rating = replace_if_not_none(movie_info.get('imdb_rating'), self.imdb_rating)
-        self.imdb_votes = replace_if_not_none(movie_info.get('imdb_votes'), self.imdb_votes)
-        self.plot_summary = replace_if_not_none(movie_info.get('plot_summary'), self.plot_summary)
-        self.plot_storyline = replace_if_not_none(movie_info.get('plot_storyline'), self.plot_storyline)
-        self.languages = replace_if_not_none(movie_info.get('languages'), self.languages)
-        self.original_release_date = replace_if_not_none(
-            str_to_arrow(movie_info.get('original_release_date')), self.original_release_date)
-        self.dutch_release_date = replace_if_not_none(str_to_arrow(movie_info.get('dutch_release_date')),
-                                                           self.dutch_release_date)
-        self.original_title = replace_if_not_none(movie_info.get('original_title'), self.original_title)
-        self.english_title = replace_if_not_none(movie_info.get('english_title'), self.english_title)
-        self.metacritic_score = replace_if_not_none(movie_info.get('metacritic_score'), self.metacritic_score)
-        self.keywords = replace_if_not_none(movie_info.get('keywords'), self.keywords)
-        self.taglines = replace_if_not_none(movie_info.get('taglines'), self.taglines)
-        self.vote_details = replace_if_not_none(movie_info.get('vote_details'), self.vote_details)
-        self.ptp_url = replace_if_not_none(movie_info.get('ptp_url'), self.ptp_url)
-        self.ptp_hd_available = replace_if_not_none(none_bool(movie_info.get('ptp_hd_available')),
-                                                         self.ptp_hd_available)
-        if movie_info.get('my_ratings') is not None:
-            for user in movie_info.get('my_ratings'):
-                if user in self.my_ratings:
-                    self.my_ratings[user].update(movie_info.get('my_ratings')[user])
-                else:
-                    self.my_ratings[user] = movie_info.get('my_ratings')[user]
-        self.date_added = replace_if_none(str_to_arrow(movie_info.get('date_added')), self.date_added)
-        self.criticker_updated = replace_if_not_none(str_to_arrow(movie_info.get('criticker_updated')),
-                                                          self.criticker_updated)
-        self.imdb_main_updated = replace_if_not_none(str_to_arrow(movie_info.get('imdb_main_updated')),
-                                                          self.imdb_main_updated)
-        self.imdb_release_updated = replace_if_not_none(str_to_arrow(movie_info.get('imdb_release_updated')),
-                                                             self.imdb_release_updated)
-        self.imdb_metacritic_updated = replace_if_not_none(
-            str_to_arrow(movie_info.get('imdb_metacritic_updated')), self.imdb_metacritic_updated)
-        self.imdb_keywords_updated = replace_if_not_none(
-            str_to_arrow(movie_info.get('imdb_keywords_updated')), self.imdb_keywords_updated)
-        self.imdb_taglines_updated = replace_if_not_none(
-            str_to_arrow(movie_info.get('imdb_taglines_updated')), self.imdb_taglines_updated)
-        self.imdb_vote_details_updated = replace_if_not_none(
-            str_to_arrow(movie_info.get('imdb_vote_details_updated')), self.imdb_vote_details_updated)
-        self.omdb_updated = replace_if_not_none(str_to_arrow(movie_info.get('omdb_updated')),
-                                                     self.omdb_updated)
-        self.imdb_plot_updated = replace_if_not_none(str_to_arrow(movie_info.get('imdb_plot_updated')),
-                                                          self.imdb_plot_updated)
-        self.ptp_updated = replace_if_not_none(str_to_arrow(movie_info.get('ptp_updated')),
-                                                    self.ptp_updated)
-        self.netflix_id = replace_if_not_none(movie_info.get('netflix_id'), self.netflix_id)
-        self.netflix_title = replace_if_not_none(movie_info.get('netflix_title'), self.netflix_title)
-        self.netflix_rating = replace_if_not_none(movie_info.get('netflix_rating'), self.netflix_rating)
-        self.netflix_updated = replace_if_not_none(str_to_arrow(movie_info.get('netflix_updated')),
-                                                   self.netflix_updated)
+        for key, value in movie_info.items():
+            field = FIELDS.get(key)
+            if field is None or value is None:
+                continue
+            coerce, policy = field
+            if coerce is not None:
+                value = coerce(value)
+            if policy == REPLACE:
+                # A value that was never loaded counts as changed, so that setting it doesn't need a load
+                if (key in LAZY_ATTRIBUTES and not self.is_loaded(key)) or getattr(self, key) != value:
+                    self.changed_attributes.add(key)
+                setattr(self, key, value)
+            elif policy == KEEP_FIRST:
+                if getattr(self, key) is None:
+                    self.changed_attributes.add(key)
+                    setattr(self, key, value)
+            elif policy == MERGE_PER_USER:
+                for user, ratings in value.items():
+                    old_ratings = self.my_ratings.get(user, {})
+                    new_ratings = dict(old_ratings, **ratings)
+                    if new_ratings != old_ratings:
+                        self.changed_attributes.add(key)
+                    self.my_ratings[user] = new_ratings
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Creates movies in bulk from records that were loaded from the database.
+        This skips the validation and change tracking of update_from_dict, so the movies start without changes.
+        :param records: an iterable of movie dictionaries
+        :return: a list of Movie objects
+        """
+        movies = []
+        for record in records:
+            movie = cls.__new__(cls)
+            movie.set_defaults()
+            for key, value in record.items():
+                field = FIELDS.get(key)
+                if field is None or value is None:
+                    continue
+                coerce, policy = field
+                if policy == MERGE_PER_USER:
+                    value = {user: dict(ratings) for user, ratings in value.items()}
+                elif coerce is not None:
+                    value = coerce(value)
+                setattr(movie, key, value)
+            movie.changed_attributes = set()
+            movies.append(movie)
+        return movies
+
+    def to_dict(self):
+        """
+        :return: a dictionary with the value of every attribute, like vars() would give for an object without slots
+        """
+        return dict(zip(ATTRIBUTES, get_attributes(self)))
+
+    def __getstate__(self):
+        # The loader refers to the database, which shouldn't end up in a pickle
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state['loader'] = None
+        return None, state
+
+    def is_loaded(self, attribute):
+        return getattr(self, '_' + attribute) is not NOT_LOADED
+
+    def unload(self, attributes, loader):
+        """
+        Drops the values of lazy attributes, which are loaded again on first access
+        :param attributes: the names of the lazy attributes
+        :param loader: a function that gets an attribute name and a criticker id, and sets the attribute of the movie
+        """
+        for attribute in attributes:
+            setattr(self, '_' + attribute, NOT_LOADED)
+        self.loader = loader
+
+    def reset_changed_attributes(self):
+        self.changed_attributes = set()
 
     def get_floating_release_year(self):
         if self.original_release_date is None:
@@ -154,12 +196,30 @@ class Movie(object):
             return year + (reldate_ts - yearstart_ts)/year_length
 
 
-def replace_if_not_none(new_value, old_value):
-    return new_value if new_value is not None else old_value
+class LazyAttribute(object):
+    def __init__(self, name, slot):
+        """
+        Gives access to an attribute that is stored in a slot, and asks the loader of the movie for its value
+        if it wasn't loaded yet
+        """
+        self.name = name
+        self.slot = slot
+
+    def __get__(self, movie, owner=None):
+        if movie is None:
+            return self
+        value = self.slot.__get__(movie, owner)
+        if value is NOT_LOADED:
+            movie.loader(self.name, movie.crit_id)
+            value = self.slot.__get__(movie, owner)
+        return value
+
+    def __set__(self, movie, value):
+        self.slot.__set__(movie, value)
 
 
-def replace_if_none(new_value, old_value):
-    return new_value if old_value is None else old_value
+for lazy_attribute in LAZY_ATTRIBUTES:
+    setattr(Movie, lazy_attribute, LazyAttribute(lazy_attribute, getattr(Movie, '_' + lazy_attribute)))
 
 
 def str_to_arrow(s):
@@ -167,6 +227,9 @@ def str_to_arrow(s):
         return arrow.get(s)
     if isinstance(s, arrow.Arrow) or s is None:
         return s
+    if isinstance(s, datetime):
+        # Datetimes from the database are naive and in UTC, and don't need to be parsed
+        return arrow.Arrow.fromdatetime(s)
     else:
         raise Exception("the provided entry is of an incompatible data type!")
 
@@ -175,4 +238,20 @@ def none_bool(b):
     if b is None:
         return None
     else:
-        return bool(b)
\ No newline at end of file
+        return bool(b)
+
+
+# How update_from_dict handles each key: values that aren't None replace the current value,
+# only fill in a missing value, or are merged per user
+REPLACE = 'replace'
+KEEP_FIRST = 'keep_first'
+MERGE_PER_USER = 'merge_per_user'
+FIELDS = {name: (None, REPLACE) for name in ATTRIBUTES}
+FIELDS.update({name: (str_to_arrow, REPLACE)
+               for name in ['original_release_date', 'dutch_release_date', 'criticker_updated', 'imdb_main_updated',
+                            'imdb_release_updated', 'imdb_metacritic_updated', 'imdb_keywords_updated',
+                            'imdb_taglines_updated', 'imdb_vote_details_updated', 'imdb_plot_updated', 'omdb_updated',
+                            'ptp_updated', 'netflix_updated']})
+FIELDS['date_added'] = (str_to_arrow, KEEP_FIRST)
+FIELDS['ptp_hd_available'] = (none_bool, REPLACE)
+FIELDS['my_ratings'] = (None, MERGE_PER_USER)
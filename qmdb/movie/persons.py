@@ -0,0 +1,41 @@
+import sys
+
+
+class PersonRegistry:
+    def __init__(self):
+        """
+        Keeps a single person dictionary per person id, which all movies with that person share.
+        A prolific actor then takes up memory once instead of once for every movie.
+        The shared dictionaries shouldn't be changed in place.
+        """
+        self.persons = {}
+
+    def get(self, person_id, name, canonical_name):
+        """
+        :return: the shared dictionary with the canonical name, name and person id of the person
+        """
+        person = self.persons.get(person_id)
+        if person is None or person['name'] != name or person['canonical_name'] != canonical_name:
+            person = {'canonical_name': intern_string(canonical_name),
+                      'name': intern_string(name),
+                      'person_id': person_id}
+            self.persons[person_id] = person
+        return person
+
+    def __len__(self):
+        return len(self.persons)
+
+
+def intern_string(s):
+    return None if s is None else sys.intern(s)
+
+
+def intern_strings(l):
+    """
+    Interns categorical strings such as genres, countries, languages and keywords,
+    so that each distinct value is stored only once
+    """
+    return None if l is None else [sys.intern(s) for s in l]
+
+
+person_registry = PersonRegistry()
@@ -0,0 +1,62 @@
+import arrow
+import numpy as np
+
+from qmdb.database.columns import MovieColumns
+from qmdb.movie.movie import Movie
+
+
+def create_movie_columns():
+    return MovieColumns({'crit_id': 'mediumint unsigned not null',
+                         'year': 'smallint unsigned',
+                         'imdb_year': 'smallint unsigned',
+                         'title': 'varchar(256) not null',
+                         'crit_popularity': 'float',
+                         'original_release_date': 'datetime',
+                         'date_added': 'datetime(6) not null'})
+
+
+def test_build_and_update():
+    columns = create_movie_columns()
+    movies = [Movie({'crit_id': 1, 'year': 1999, 'title': 'The Matrix', 'crit_popularity': 10.0,
+                     'date_added': arrow.get('2018-02-04 23:01:58+01:00')}),
+              Movie({'crit_id': 2, 'title': 'Inception'})]
+    columns.build(movies)
+    assert list(columns.crit_ids) == [1, 2]
+    assert list(columns.nulls('year')) == [False, True]
+    assert list(columns.column('year', fill=np.nan)[:1]) == [1999]
+    assert np.isnan(columns.column('year', fill=np.nan)[1])
+    assert list(columns.column('title')) == ['The Matrix', 'Inception']
+    assert list(columns.values('crit_popularity')) == [10.0]
+    assert columns.values('date_added')[0] == np.datetime64('2018-02-04T22:01:58', 'us')
+    movies[1].update_from_dict({'year': 2010})
+    columns.update(movies[1])
+    for crit_id in range(3, 40):
+        columns.update(Movie({'crit_id': crit_id, 'year': 2000 + crit_id}))
+    assert columns.size == 39
+    assert list(columns.crit_ids[:3]) == [1, 2, 3]
+    assert list(columns.values('year')[:3]) == [1999, 2010, 2003]
+    assert columns.nulls('title').sum() == 37
+
+
+def test_remove():
+    columns = create_movie_columns()
+    columns.build([Movie({'crit_id': crit_id, 'year': 2000 + crit_id}) for crit_id in range(1, 4)]
+                  + [Movie({'crit_id': 4, 'title': 'Inception'})])
+    columns.remove(2)
+    columns.remove(5)
+    assert list(columns.crit_ids) == [1, 4, 3]
+    assert list(columns.column('title')[1:2]) == ['Inception']
+    assert list(columns.nulls('year')) == [False, True, False]
+    columns.remove(3)
+    columns.update(Movie({'crit_id': 6, 'year': 2006}))
+    assert list(columns.crit_ids) == [1, 4, 6]
+    assert list(columns.values('year')) == [2001, 2006]
+
+
+def test_floating_release_years():
+    columns = create_movie_columns()
+    movies = [Movie({'crit_id': 1, 'year': 1999}),
+              Movie({'crit_id': 2, 'year': 1999, 'imdb_year': 2000}),
+              Movie({'crit_id': 3, 'year': 1999, 'original_release_date': arrow.get('2000-07-01')})]
+    columns.build(movies)
+    assert np.allclose(columns.floating_release_years(), [movie.get_floating_release_year() for movie in movies])
@@ -35,6 +35,7 @@ def test_person_to_dict():
     assert person_dict == {'canonical_name': 'Kindt, Tijl',
                            'name': 'Tijl Kindt',
                            'person_id': 1234}
+    assert imdb_scraper.person_to_dict(person) is person_dict
 
 
 def test_remove_duplicate_dicts():
@@ -0,0 +1,65 @@
+from qmdb.database.indexes import AttributeIndex, InvertedIndex, SortedIndex, intersect_sorted
+from qmdb.movie.movie import Movie
+
+
+def test_attribute_index():
+    index = AttributeIndex('imdbid')
+    movies = [Movie({'crit_id': 1, 'imdbid': 101}),
+              Movie({'crit_id': 2, 'imdbid': 102}),
+              Movie({'crit_id': 3, 'imdbid': 102}),
+              Movie({'crit_id': 4})]
+    index.build(movies)
+    assert index.crit_ids == {101: {1}, 102: {2, 3}}
+    assert index.get(102) == {2, 3}
+    assert index.get(103) == set()
+    movies[1].update_from_dict({'imdbid': 103})
+    index.update(movies[1])
+    movies[3].update_from_dict({'imdbid': 101})
+    index.update(movies[3])
+    assert index.crit_ids == {101: {1, 4}, 102: {3}, 103: {2}}
+    index.remove(3)
+    assert index.crit_ids == {101: {1, 4}, 103: {2}}
+
+
+def test_inverted_index():
+    index = InvertedIndex('director', key='person_id')
+    movies = [Movie({'crit_id': 3, 'director': [{'person_id': 13, 'name': 'Tom Cruise'}]}),
+              Movie({'crit_id': 1, 'director': [{'person_id': 13, 'name': 'Tom Cruise'},
+                                                {'person_id': 14, 'name': 'J.J. Abrams'}]}),
+              Movie({'crit_id': 2})]
+    index.build(movies)
+    assert index.crit_ids == {13: [1, 3], 14: [1]}
+    movies[2].update_from_dict({'director': [{'person_id': 13, 'name': 'Tom Cruise'}]})
+    index.update(movies[2])
+    movies[1].director = [{'person_id': 14, 'name': 'J.J. Abrams'}]
+    index.update(movies[1])
+    assert index.crit_ids == {13: [2, 3], 14: [1]}
+    assert index.get(13) == [2, 3]
+    index.remove(1)
+    assert index.crit_ids == {13: [2, 3]}
+
+
+def test_intersect_sorted():
+    assert intersect_sorted([[1, 3, 5, 7, 9], [3, 4, 5, 9], [0, 5, 9, 10]]) == [5, 9]
+    assert intersect_sorted([[1, 3], []]) == []
+    assert intersect_sorted([]) == []
+
+
+def test_sorted_index():
+    index = SortedIndex('year')
+    movies = [Movie({'crit_id': 1, 'year': 1999}),
+              Movie({'crit_id': 2, 'year': 2010}),
+              Movie({'crit_id': 3, 'year': 1999}),
+              Movie({'crit_id': 4})]
+    index.build(movies)
+    assert index.range(1999, 1999) == [1, 3]
+    assert index.range(2000) == [2]
+    assert index.range(high=2010) == [1, 2, 3]
+    movies[3].update_from_dict({'year': 2005})
+    index.update(movies[3])
+    movies[0].update_from_dict({'year': 2011})
+    index.update(movies[0])
+    assert index.range(2000, 2010) == [2, 4]
+    assert index.entries == [(1999, 3), (2005, 4), (2010, 2), (2011, 1)]
+    index.remove(2)
+    assert index.range() == [1, 3, 4]
@@ -19,3 +19,61 @@ def test_get_floating_release_year():
                'year': 2016,
                'original_release_date': None})
     assert m.get_floating_release_year() == pytest.approx(2016.5, 0.01)
+
+
+def test_changed_attributes():
+    m = Movie({'crit_id': 123,
+               'title': 'The Matrix',
+               'genres': ['Action']})
+    assert m.changed_attributes == {'crit_id', 'title', 'genres'}
+    m.reset_changed_attributes()
+    m.update_from_dict({'title': 'The Matrix', 'year': 1999, 'genres': ['Action']})
+    assert m.changed_attributes == {'year'}
+    m.reset_changed_attributes()
+    m.update_from_dict({'my_ratings': {'tijl': {'rating': 90}}})
+    m.update_from_dict({'my_ratings': {'tijl': {'rating': 90}}, 'title': None})
+    assert m.changed_attributes == {'my_ratings'}
+    m.reset_changed_attributes()
+    m.update_from_dict({'my_ratings': {'tijl': {'pred_score': 80.0}}})
+    assert m.changed_attributes == {'my_ratings'}
+    assert m.my_ratings == {'tijl': {'rating': 90, 'pred_score': 80.0}}
+
+
+def test_to_dict():
+    m = Movie({'crit_id': 123,
+               'title': 'The Matrix'})
+    assert not hasattr(m, '__dict__')
+    d = m.to_dict()
+    assert d['crit_id'] == 123
+    assert d['title'] == 'The Matrix'
+    assert d['year'] is None
+    assert 'changed_attributes' not in d
+    with pytest.raises(AttributeError):
+        m.some_attribute = 1
+
+
+def test_update_from_dict_policies():
+    m = Movie({'crit_id': 123,
+               'date_added': '2018-02-04 23:01:58+01:00',
+               'ptp_hd_available': 1,
+               'unknown_key': 'ignored'})
+    assert m.date_added == arrow.get('2018-02-04 23:01:58+01:00')
+    assert m.ptp_hd_available is True
+    m.reset_changed_attributes()
+    m.update_from_dict({'date_added': arrow.get('2019-01-01'), 'omdb_updated': '2019-01-01', 'imdb_rating': None})
+    assert m.date_added == arrow.get('2018-02-04 23:01:58+01:00')
+    assert m.omdb_updated == arrow.get('2019-01-01')
+    assert m.changed_attributes == {'omdb_updated'}
+
+
+def test_from_records():
+    movies = Movie.from_records([{'crit_id': 123,
+                                  'title': 'The Matrix',
+                                  'date_added': '2018-02-04 23:01:58+01:00',
+                                  'my_ratings': {'tijl': {'rating': 90}},
+                                  'last_modified': None}])
+    assert movies[0].title == 'The Matrix'
+    assert movies[0].year is None
+    assert movies[0].date_added == arrow.get('2018-02-04 23:01:58+01:00')
+    assert movies[0].my_ratings == {'tijl': {'rating': 90}}
+    assert movies[0].changed_attributes == set()
@@ -1,3 +1,5 @@
+import os
+
 import arrow
 import pytest
 
@@ -266,7 +268,7 @@ def test_set_netflix_genres():
                                      'movies_updated': None}}
 
 
-def test_create_imdbid_to_crit_id_dict():
+def test_build_indexes():
     create_test_tables()
     db = MySQLDatabase(schema='qmdb_test', env='test')
     db.movies = {1: Movie({'crit_id': 1,
@@ -277,8 +279,10 @@ def test_create_imdbid_to_crit_id_dict():
                            'imdbid': 102}),
                  4: Movie({'crit_id': 4,
                            'imdbid': None})}
-    db.create_imdbid_to_crit_id_dict()
-    assert db.imdbid_to_critid == {101: 1, 102: {2, 3}}
+    db.build_indexes()
+    assert db.attribute_indexes['imdbid'].crit_ids == {101: {1}, 102: {2, 3}}
+    assert db.get_crit_ids('imdbid', 102) == {2, 3}
+    assert db.get_crit_ids('imdbid', 103) == set()
 
 
 def test_add_missing_columns():
@@ -304,3 +308,124 @@ def test_add_missing_columns():
     actual_cols_dict = {d['column_name']: d['column_type'] for d in actual_cols}
     assert actual_cols_dict == db.columns_netflix_genres
     assert list(actual_cols_dict.keys()) == list(db.columns_netflix_genres)
+
+
+def test_save_movies_bulk():
+    create_test_tables()
+    db = MySQLDatabase(schema='qmdb_test', env='test')
+    movies = [{'crit_id': 1234,
+               'title': 'The Matrix 2',
+               'genres': ['Action', 'Sci-Fi']},
+              {'crit_id': 12345,
+               'crit_url': 'blahblah',
+               'title': 'Pulp Fiction',
+               'date_added': arrow.now(),
+               'languages': ['English'],
+               'my_ratings': {'tijl': {'rating': 90}}},
+              {'crit_id': 1234,
+               'my_ratings': {'tijl': {'pred_score': 80.0}}}]
+    db.save_movies(movies, verbose=False, chunk_size=2)
+    db = MySQLDatabase(schema='qmdb_test', env='test')
+    assert db.movies[1234].title == 'The Matrix 2'
+    assert db.movies[1234].year == 1999
+    assert db.movies[1234].genres == ['Action', 'Sci-Fi']
+    assert db.movies[1234].languages == ['English', 'French']
+    assert db.movies[1234].my_ratings == {'tijl': {'pred_score': 80.0}}
+    assert db.movies[12345].title == 'Pulp Fiction'
+    assert db.movies[12345].languages == ['English']
+    assert db.movies[12345].my_ratings == {'tijl': {'rating': 90}}
+    remove_test_tables(db)
+
+
+def test_set_movie_only_changes(mocker):
+    create_test_tables()
+    db = MySQLDatabase(schema='qmdb_test', env='test')
+    mocker.patch.object(db, 'update_single_record')
+    mocker.patch.object(db, 'update_record')
+    mocker.patch.object(db, 'update_multiple_records')
+    db.set_movie({'crit_id': 1234, 'title': 'The Matrix'})
+    assert db.update_single_record.call_count == 0
+    assert db.update_record.call_count == 0
+    assert db.update_multiple_records.call_count == 0
+    db.set_movie({'crit_id': 1234, 'netflix_rating': 4.5, 'genres': ['Action']})
+    assert db.update_single_record.call_count == 0
+    assert db.update_record.call_args[0] == ('movies', {'crit_id': 1234, 'netflix_rating': 4.5})
+    assert db.update_multiple_records.call_count == 1
+    assert db.update_multiple_records.call_args[0][0] == 'genres'
+    assert db.movies[1234].changed_attributes == set()
+    remove_test_tables(db)
+
+
+def test_sync_multiple_records(mocker):
+    create_test_tables()
+    db = MySQLDatabase(schema='qmdb_test', env='test')
+    d = {'crit_id': 1234,
+         'n_rows': 2,
+         'language': ['English', 'Dutch'],
+         'rank': [1, 2]}
+    db.connect()
+    mocker.spy(db, 'upsert_records')
+    db.sync_multiple_records('languages', [d])
+    db.close()
+    assert db.upsert_records.call_args[0] == ('languages', [{'crit_id': 1234, 'language': 'Dutch', 'rank': 2}])
+    db.load()
+    assert db.movies[1234].languages == ['English', 'Dutch']
+    assert db.movies[49141].languages == ['English']
+    remove_test_tables(db)
+
+
+def test_load_in_parallel():
+    create_test_tables()
+    db = MySQLDatabase(schema='qmdb_test', env='test', load_threads=4)
+    assert list(db.movies.keys()) == [1234, 49141]
+    assert db.movies[1234].languages == ['English', 'French']
+    assert [e['name'] for e in db.movies[1234].director] == ['Lana Wachowski', 'J.J. Abrams']
+    assert db.movies[49141].cast[0]['name'] == 'Natalie Portman'
+    remove_test_tables(db)
+
+
+def test_load_snapshot(tmpdir, mocker):
+    create_test_tables()
+    snapshot_path = str(tmpdir.join('qmdb_test.pkl'))
+    db = MySQLDatabase(schema='qmdb_test', env='test', snapshot_path=snapshot_path)
+    assert os.path.isfile(snapshot_path)
+    mocker.spy(MySQLDatabase, 'load_movies')
+    db = MySQLDatabase(schema='qmdb_test', env='test', snapshot_path=snapshot_path)
+    assert MySQLDatabase.load_movies.call_count == 0
+    assert list(db.movies.keys()) == [1234, 49141]
+    assert db.movies[1234].languages == ['English', 'French']
+    db.set_movie({'crit_id': 1234, 'title': 'The Matrix 2'})
+    db = MySQLDatabase(schema='qmdb_test', env='test', snapshot_path=snapshot_path)
+    assert MySQLDatabase.load_movies.call_count == 1
+    assert db.movies[1234].title == 'The Matrix 2'
+    remove_test_tables(db)
+
+
+def test_refresh():
+    create_test_tables()
+    db = MySQLDatabase(schema='qmdb_test', env='test')
+    other_db = MySQLDatabase(schema='qmdb_test', env='test')
+    movie = db.movies[1234]
+    other_db.set_movie({'crit_id': 1234, 'title': 'The Matrix 2', 'languages': ['Dutch']})
+    other_db.set_movie({'crit_id': 12345, 'crit_url': 'blahblah', 'title': 'Pulp Fiction',
+                        'date_added': arrow.now()})
+    assert sorted(db.refresh()) == [1234, 12345]
+    assert db.movies[1234] is movie
+    assert movie.title == 'The Matrix 2'
+    assert movie.languages == ['Dutch']
+    assert movie.changed_attributes == set()
+    assert db.movies[12345].title == 'Pulp Fiction'
+    assert db.movies[49141].languages == ['English']
+    assert db.refresh() == []
+    remove_test_tables(db)
+
+
+def test_secondary_indexes():
+    create_test_tables()
+    db = MySQLDatabase(schema='qmdb_test', env='test')
+    db.connect()
+    assert db.get_table_indexes('movies') == {'movies_imdbid': ['imdbid'], 'movies_netflix_id': ['netflix_id'],
+                                              'movies_last_modified': ['last_modified']}
+    assert db.get_table_indexes('ratings') == {'ratings_user_type_score': ['user', 'type', 'score']}
+    db.close()
+    remove_test_tables(db)
@@ -0,0 +1,20 @@
+from qmdb.movie.persons import PersonRegistry, intern_strings
+
+
+def test_person_registry():
+    registry = PersonRegistry()
+    person = registry.get(13, 'Tom Cruise', 'Cruise, Tom')
+    assert person == {'canonical_name': 'Cruise, Tom', 'name': 'Tom Cruise', 'person_id': 13}
+    assert registry.get(13, 'Tom Cruise', 'Cruise, Tom') is person
+    assert registry.get(14, 'J.J. Abrams', 'Abrams, J.J.') is not person
+    renamed = registry.get(13, 'Thomas Cruise', 'Cruise, Thomas')
+    assert renamed['name'] == 'Thomas Cruise'
+    assert registry.get(13, 'Thomas Cruise', 'Cruise, Thomas') is renamed
+    assert len(registry) == 2
+
+
+def test_intern_strings():
+    genres = intern_strings([''.join(['Dra', 'ma']), 'Thriller'])
+    assert genres == ['Drama', 'Thriller']
+    assert genres[0] is intern_strings([''.join(['Dr', 'ama'])])[0]
+    assert intern_strings(None) is None
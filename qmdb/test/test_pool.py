@@ -0,0 +1,57 @@
+import time
+
+from qmdb.database.pool import ConnectionPool
+
+
+class FakeConnection:
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+        self.closed = False
+        self.rollbacks = 0
+
+    def ping(self, reconnect=True):
+        if not self.healthy:
+            raise ConnectionError
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+def test_reuse_connection():
+    pool = ConnectionPool(FakeConnection, size=2)
+    conn = pool.get()
+    pool.put(conn)
+    assert conn.rollbacks == 1
+    assert pool.get() is conn
+
+
+def test_replace_stale_connection():
+    pool = ConnectionPool(FakeConnection, size=2)
+    conn = pool.get()
+    conn.healthy = False
+    pool.put(conn)
+    new_conn = pool.get()
+    assert new_conn is not conn
+    assert conn.closed
+
+
+def test_replace_idle_connection():
+    pool = ConnectionPool(FakeConnection, size=2, max_idle=10)
+    conn = pool.get()
+    pool.idle.put((conn, time.time() - 20))
+    pool.slots.release()
+    new_conn = pool.get()
+    assert new_conn is not conn
+    assert conn.closed
+
+
+def test_pool_size():
+    pool = ConnectionPool(FakeConnection, size=1)
+    conn = pool.get()
+    assert not pool.slots.acquire(blocking=False)
+    pool.discard(conn)
+    assert conn.closed
+    assert pool.get() is not conn
@@ -0,0 +1,20 @@
+import pytest
+
+from qmdb.database.query import parse_path, make_getter
+from qmdb.movie.movie import Movie
+
+
+def test_parse_path():
+    assert parse_path('year') == ['year']
+    assert parse_path("my_ratings['tijl']['pred_score']") == ['my_ratings', 'tijl', 'pred_score']
+    assert parse_path('cast[0]["name"]') == ['cast', 0, 'name']
+    with pytest.raises(ValueError):
+        parse_path("my_ratings['tijl'].keys()")
+
+
+def test_make_getter():
+    movie = Movie({'crit_id': 1, 'year': 1999, 'my_ratings': {'tijl': {'pred_score': 80.0}}})
+    assert make_getter('year')(movie) == 1999
+    assert make_getter("my_ratings['tijl']['pred_score']")(movie) == 80.0
+    assert make_getter("my_ratings['someone']['pred_score']")(movie) is None
+    assert make_getter("cast[0]['name']")(movie) is None
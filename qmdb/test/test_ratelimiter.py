@@ -0,0 +1,92 @@
+import time
+
+import arrow
+import pytest
+
+from qmdb.database.sqlite import SQLiteDatabase
+from qmdb.interfaces.ratelimiter import RateLimiter, TokenBucket
+
+
+@pytest.fixture
+def clock(mocker):
+    """
+    A fake clock, which time.sleep moves forward instead of waiting
+    """
+    now = [1e9]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+    mocker.patch.object(time, 'time', lambda: now[0])
+    mocker.patch.object(time, 'sleep', sleep)
+    return sleeps
+
+
+def test_token_bucket():
+    bucket = TokenBucket(3600, 2, updated=0)
+    assert bucket.get_wait_time(0) == 0
+    bucket.take(0)
+    bucket.take(0)
+    assert bucket.get_wait_time(0) == pytest.approx(1)
+    assert bucket.get_wait_time(0.5) == pytest.approx(0.5)
+    # The bucket doesn't fill up beyond its capacity
+    assert bucket.get_wait_time(100) == 0
+    assert bucket.tokens == 2
+    bucket.suspended_until = 150
+    assert bucket.get_wait_time(100) == pytest.approx(50)
+
+
+def test_acquire(clock):
+    rate_limiter = RateLimiter(limits={'www.criticker.com': (360, 3)})
+    for _ in range(5):
+        rate_limiter.acquire('www.criticker.com')
+    # After a burst of 3 requests, the others have to wait 10 seconds each
+    assert clock == [pytest.approx(10), pytest.approx(10)]
+    rate_limiter.acquire('www.omdbapi.com')
+    assert len(clock) == 2
+
+
+def test_suspend(clock):
+    rate_limiter = RateLimiter()
+    assert not rate_limiter.is_suspended('unogs-unogs-v1.p.mashape.com')
+    rate_limiter.suspend('unogs-unogs-v1.p.mashape.com', hours=18)
+    assert rate_limiter.is_suspended('unogs-unogs-v1.p.mashape.com')
+    rate_limiter.acquire('unogs-unogs-v1.p.mashape.com')
+    assert sum(clock) == pytest.approx(18 * 3600)
+    assert not rate_limiter.is_suspended('unogs-unogs-v1.p.mashape.com')
+
+
+def test_persisted_rate_limits(tmpdir, clock):
+    db = SQLiteDatabase(str(tmpdir.join('qmdb_test.db')), from_scratch=True)
+    rate_limiter = RateLimiter(limits={'www.criticker.com': (360, 3)})
+    rate_limiter.attach(db)
+    for _ in range(3):
+        rate_limiter.acquire('www.criticker.com')
+    rate_limiter.suspend('unogs-unogs-v1.p.mashape.com', hours=1)
+    # A restart continues with an empty bucket instead of allowing another burst
+    db = SQLiteDatabase(db.path)
+    rate_limiter = RateLimiter(limits={'www.criticker.com': (360, 3)})
+    rate_limiter.attach(db)
+    assert rate_limiter.buckets['www.criticker.com'].tokens == pytest.approx(0)
+    assert rate_limiter.is_suspended('unogs-unogs-v1.p.mashape.com')
+    rate_limiter.acquire('www.criticker.com')
+    assert clock == [pytest.approx(10)]
+    rows = {row['host']: row for row in db.load_rate_limits()}
+    assert arrow.get(rows['www.criticker.com']['updated']).timestamp() == pytest.approx(time.time())
+
+
+def test_rate_limits_are_stored_periodically(tmpdir, clock, mocker):
+    db = SQLiteDatabase(str(tmpdir.join('qmdb_test.db')), from_scratch=True)
+    rate_limiter = RateLimiter(limits={'www.criticker.com': (3600, 100)}, store_interval=60)
+    rate_limiter.attach(db)
+    mocker.spy(db, 'set_rate_limits')
+    for _ in range(10):
+        rate_limiter.acquire('www.criticker.com')
+    assert db.set_rate_limits.call_count == 0
+    time.sleep(60)
+    rate_limiter.acquire('www.criticker.com')
+    assert db.set_rate_limits.call_count == 1
+    assert db.load_rate_limits()[0]['tokens'] == pytest.approx(99)
+    rate_limiter.store()
+    assert db.set_rate_limits.call_count == 1
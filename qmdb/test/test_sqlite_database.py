@@ -0,0 +1,325 @@
+import os
+import sqlite3
+import time
+
+import arrow
+import pytest
+
+from qmdb.database.sqlite import SQLiteDatabase
+from qmdb.movie.movie import Movie
+from qmdb.test.test_utils import create_test_tables
+
+
+def create_test_database(tmpdir, **kwargs):
+    path = str(tmpdir.join('qmdb_test.db'))
+    create_test_tables(db=SQLiteDatabase(path, from_scratch=True))
+    return SQLiteDatabase(path, **kwargs)
+
+
+def test_database_init_from_scratch(tmpdir):
+    db = SQLiteDatabase(str(tmpdir.join('qmdb_test.db')), from_scratch=True)
+    assert db.movies == {}
+    db = SQLiteDatabase(str(tmpdir.join('qmdb_test.db')))
+    assert db.movies == {}
+
+
+def test_database_init_existing_file(tmpdir):
+    db = create_test_database(tmpdir)
+    assert list(db.movies.keys()) == [1234, 49141]
+    assert db.movies[1234].title == 'The Matrix'
+    assert db.movies[1234].languages == ['English', 'French']
+    assert [e['name'] for e in db.movies[1234].director] == ['Lana Wachowski', 'J.J. Abrams']
+    assert db.movies[1234].date_added == arrow.get('2018-02-04 23:01:58+01:00')
+    assert db.netflix_genres[1]['genre_names'] == ['All Action', 'All Anime']
+
+
+def test_add_and_update_movies(tmpdir):
+    db = create_test_database(tmpdir)
+    db.set_movie(Movie({'crit_id': 12345,
+                        'crit_url': 'blahblah',
+                        'title': 'Pulp Fiction',
+                        'date_added': arrow.now(),
+                        'genres': ['Crime', 'Drama']}))
+    db.set_movie({'crit_id': 1234, 'title': 'The Matrix 2', 'languages': ['Dutch']})
+    db = SQLiteDatabase(db.path)
+    assert db.movies[12345].title == 'Pulp Fiction'
+    assert db.movies[12345].genres == ['Crime', 'Drama']
+    assert db.movies[1234].title == 'The Matrix 2'
+    assert db.movies[1234].year == 1999
+    assert db.movies[1234].languages == ['Dutch']
+
+
+def test_failed_write_gives_up_connection(tmpdir):
+    db = create_test_database(tmpdir)
+    with pytest.raises(sqlite3.IntegrityError):
+        db.set_movie(Movie({'crit_id': 12345, 'title': 'Pulp Fiction'}))
+    assert db.connection_depth == 0
+    assert db.conn is None
+    db.set_movie({'crit_id': 1234, 'title': 'The Matrix 2'})
+    db = SQLiteDatabase(db.path)
+    assert db.movies[1234].title == 'The Matrix 2'
+    assert 12345 not in db.movies
+
+
+def test_save_movies_bulk(tmpdir):
+    for sync_mode in ['diff', 'replace']:
+        db = create_test_database(tmpdir.mkdir(sync_mode), sync_mode=sync_mode)
+        db.save_movies([{'crit_id': 1234,
+                         'title': 'The Matrix 2',
+                         'my_ratings': {'tijl': {'rating': 90}}},
+                        {'crit_id': 49141,
+                         'languages': ['English', 'Dutch']}], verbose=False)
+        db = SQLiteDatabase(db.path)
+        assert db.movies[1234].title == 'The Matrix 2'
+        assert db.movies[1234].my_ratings == {'tijl': {'rating': 90}}
+        assert db.movies[49141].languages == ['Dutch', 'English']
+
+
+def test_refresh(tmpdir):
+    db = create_test_database(tmpdir)
+    other_db = SQLiteDatabase(db.path)
+    other_db.set_movie({'crit_id': 1234, 'languages': ['Dutch']})
+    # Timestamps have a resolution of a millisecond
+    time.sleep(0.01)
+    assert db.refresh() == [1234]
+    assert db.movies[1234].languages == ['Dutch']
+    assert db.refresh() == []
+
+
+def test_refresh_keeps_unsaved_changes(tmpdir):
+    db = create_test_database(tmpdir)
+    other_db = SQLiteDatabase(db.path)
+    other_db.set_movie({'crit_id': 1234, 'languages': ['Dutch'], 'year': 1999})
+    db.movies[1234].update_from_dict({'year': 2000})
+    time.sleep(0.01)
+    assert db.refresh() == [1234]
+    assert db.movies[1234].languages == ['Dutch']
+    assert db.movies[1234].year == 2000
+    assert db.movies[1234].changed_attributes == {'year'}
+
+
+def test_refresh_removes_deleted_movies(tmpdir):
+    db = create_test_database(tmpdir)
+    other_db = SQLiteDatabase(db.path)
+    with other_db.connection():
+        other_db.c.execute("delete from movies where crit_id = %s", [1234])
+    assert db.refresh() == []
+    assert list(db.movies.keys()) == [49141]
+    assert db.find_movies(languages='French') == []
+    assert list(db.column_store.crit_ids) == [49141]
+
+
+def test_load_skips_unknown_movies(tmpdir, mocker):
+    db = create_test_database(tmpdir)
+    load_movies = SQLiteDatabase.load_movies
+
+    def load_movies_before_insert(self, modified_since=None):
+        # As if Inception was added after the movies table was read, but before its child tables were
+        movies = load_movies(self, modified_since=modified_since)
+        movies.pop(49141, None)
+        return movies
+    mocker.patch.object(SQLiteDatabase, 'load_movies', load_movies_before_insert)
+    db = SQLiteDatabase(db.path)
+    assert list(db.movies.keys()) == [1234]
+    assert db.movies[1234].languages == ['English', 'French']
+
+
+def test_load_snapshot(tmpdir, mocker):
+    snapshot_path = str(tmpdir.join('qmdb_test.pkl'))
+    db = create_test_database(tmpdir, snapshot_path=snapshot_path)
+    assert os.path.isfile(snapshot_path)
+    mocker.spy(SQLiteDatabase, 'load_movies')
+    db = SQLiteDatabase(db.path, snapshot_path=snapshot_path)
+    assert SQLiteDatabase.load_movies.call_count == 0
+    assert db.movies[1234].languages == ['English', 'French']
+    db.set_movie({'crit_id': 1234, 'title': 'The Matrix 2'})
+    db = SQLiteDatabase(db.path, snapshot_path=snapshot_path)
+    assert SQLiteDatabase.load_movies.call_count == 1
+    assert db.movies[1234].title == 'The Matrix 2'
+
+
+def test_load_profile_core(tmpdir, mocker):
+    db = create_test_database(tmpdir)
+    db.set_movies([{'crit_id': 1234, 'keywords': ['hacker', 'virtual-reality'], 'plot_summary': 'Neo wakes up.'},
+                   {'crit_id': 49141, 'keywords': ['dream']}])
+    mocker.spy(SQLiteDatabase, 'load_keywords')
+    db = SQLiteDatabase(db.path, load_profile='core', lazy_batch_size=10)
+    assert SQLiteDatabase.load_keywords.call_count == 0
+    assert not db.movies[1234].is_loaded('keywords')
+    assert db.movies[1234].keywords == ['hacker', 'virtual-reality']
+    assert db.movies[49141].keywords == ['dream']
+    assert SQLiteDatabase.load_keywords.call_count == 1
+    assert db.movies[1234].plot_summary == 'Neo wakes up.'
+    assert db.movies[49141].plot_summary is None
+    db.set_movie({'crit_id': 49141, 'plot_storyline': 'A thief steals secrets through dreams.'})
+    assert db.movies[49141].plot_storyline == 'A thief steals secrets through dreams.'
+    assert db.movies[1234].plot_storyline is None
+
+
+def test_load_profile_core_keywords_index(tmpdir, mocker):
+    db = create_test_database(tmpdir)
+    db.set_movies([{'crit_id': 1234, 'keywords': ['hacker', 'virtual-reality']},
+                   {'crit_id': 49141, 'keywords': ['dream']}])
+    mocker.spy(SQLiteDatabase, 'load_keywords')
+    db = SQLiteDatabase(db.path, load_profile='core')
+    assert db.find_movies(keywords='hacker') == [1234]
+    assert [movie.crit_id for movie in db.query(keywords=['dream'])] == [49141]
+    assert SQLiteDatabase.load_keywords.call_count == 1
+    assert not db.movies[1234].is_loaded('keywords')
+    db.set_movie({'crit_id': 49141, 'keywords': ['dream', 'hacker']})
+    assert db.find_movies(keywords='hacker') == [1234, 49141]
+
+
+def test_load_profile_core_snapshot(tmpdir):
+    snapshot_path = str(tmpdir.join('qmdb_test.pkl'))
+    db = create_test_database(tmpdir)
+    db.set_movie({'crit_id': 1234, 'taglines': ['Free your mind']})
+    SQLiteDatabase(db.path, load_profile='core', snapshot_path=snapshot_path)
+    db = SQLiteDatabase(db.path, load_profile='core', snapshot_path=snapshot_path)
+    assert not db.movies[1234].is_loaded('taglines')
+    assert db.movies[1234].taglines == ['Free your mind']
+
+
+def test_schedule(tmpdir):
+    db = create_test_database(tmpdir)
+    db.set_schedule([(1234, 'criticker', arrow.get('2018-01-01'), 1.0),
+                     (1234, 'omdb', arrow.get('2018-01-03'), 10.0),
+                     (49141, 'criticker', arrow.get('2018-01-02'), 2.0)])
+    db.set_schedule([(1234, 'criticker', arrow.get('2018-01-05'), 1.0)])
+    rows = db.load_schedule()
+    assert [(row['crit_id'], row['source']) for row in rows] == \
+        [(49141, 'criticker'), (1234, 'omdb'), (1234, 'criticker')]
+    assert arrow.get(rows[0]['next_update']) == arrow.get('2018-01-02')
+    assert arrow.get(rows[2]['next_update']) == arrow.get('2018-01-05')
+
+
+def test_create_rate_limits_table(tmpdir):
+    db = create_test_database(tmpdir)
+    db.connect()
+    db.c.execute("drop table rate_limits")
+    db.c.execute("create table unogs_suspension (id integer primary key, last_suspension datetime(6))")
+    db.c.execute("insert into unogs_suspension values (1, '2018-03-01 12:00:00.000000')")
+    db.c.execute("update schema_version set version = 3")
+    db.close()
+    db = SQLiteDatabase(db.path)
+    rows = db.load_rate_limits()
+    assert [row['host'] for row in rows] == ['unogs-unogs-v1.p.mashape.com']
+    assert arrow.get(rows[0]['suspended_until']) == arrow.get('2018-03-02 06:00:00')
+    db.connect()
+    assert db.get_table_columns('unogs_suspension') == {}
+    db.close()
+
+
+def test_convert_to_datetime(tmpdir):
+    db = create_test_database(tmpdir)
+    db.columns_movies['criticker_updated'] = 'varchar(32)'
+    db.connect()
+    db.rebuild_table('movies')
+    db.c.execute("update movies set criticker_updated = '2018-02-04 23:01:58+01:00' where crit_id = 1234")
+    db.c.execute("drop table schema_version")
+    db.close()
+    db = SQLiteDatabase(db.path)
+    assert db.movies[1234].criticker_updated == arrow.get('2018-02-04 23:01:58+01:00')
+    assert db.movies[1234].date_added == arrow.get('2018-02-04 23:01:58+01:00')
+    db.connect()
+    assert db.get_table_columns('movies')['criticker_updated'] == 'datetime(6)'
+    db.close()
+    assert db.get_movies_not_updated_since('criticker_updated', arrow.get('2018-02-05')) == [1234, 49141]
+    assert db.get_movies_not_updated_since('criticker_updated', arrow.get('2018-02-04')) == [49141]
+
+
+def test_migrate(tmpdir, mocker):
+    db = create_test_database(tmpdir)
+    db.connect()
+    assert db.get_schema_version() == len(db.migrations)
+    db.c.execute("drop table schema_version")
+    db.c.execute("drop table keywords")
+    db.close()
+    mocker.spy(SQLiteDatabase, 'add_missing_columns')
+    db = SQLiteDatabase(db.path)
+    assert SQLiteDatabase.add_missing_columns.call_count == len(db.primary_keys)
+    db.connect()
+    assert db.get_schema_version() == len(db.migrations)
+    assert 'keyword' in db.get_table_columns('keywords')
+    db.close()
+    db = SQLiteDatabase(db.path)
+    assert SQLiteDatabase.add_missing_columns.call_count == len(db.primary_keys)
+
+
+def test_update_secondary_indexes(tmpdir):
+    db = create_test_database(tmpdir)
+    db.connect()
+    assert db.get_table_indexes('movies') == {'movies_imdbid': ['imdbid'], 'movies_netflix_id': ['netflix_id'],
+                                              'movies_last_modified': ['last_modified']}
+    assert db.get_table_indexes('ratings') == {'ratings_user_type_score': ['user', 'type', 'score']}
+    db.drop_index('ratings', 'ratings_user_type_score')
+    db.create_index('movies', ['crit_id'])
+    db.c.execute("update schema_version set version = 1")
+    db.close()
+    db = SQLiteDatabase(db.path)
+    db.connect()
+    assert db.get_table_indexes('movies') == {'movies_imdbid': ['imdbid'], 'movies_netflix_id': ['netflix_id'],
+                                              'movies_last_modified': ['last_modified']}
+    assert db.get_table_indexes('ratings') == {'ratings_user_type_score': ['user', 'type', 'score']}
+    db.close()
+
+
+def test_create_last_modified_index(tmpdir):
+    db = create_test_database(tmpdir)
+    db.connect()
+    db.drop_index('movies', 'movies_last_modified')
+    db.c.execute("update schema_version set version = 4")
+    db.close()
+    db = SQLiteDatabase(db.path)
+    db.connect()
+    assert db.get_table_indexes('movies')['movies_last_modified'] == ['last_modified']
+    db.close()
+
+
+def test_attribute_indexes(tmpdir):
+    db = create_test_database(tmpdir)
+    assert db.get_crit_ids('imdbid', 133093) == {1234}
+    assert db.get_crit_ids('crit_url', 'http://www.criticker.com/film/Inception/') == {49141}
+    db.set_movie({'crit_id': 12345, 'crit_url': 'blahblah', 'title': 'Pulp Fiction', 'date_added': arrow.now(),
+                  'imdbid': 133093})
+    db.set_movie({'crit_id': 49141, 'netflix_id': 70131314})
+    assert db.get_crit_ids('imdbid', 133093) == {1234, 12345}
+    assert db.get_crit_ids('netflix_id', 70131314) == {49141}
+
+
+def test_find_movies(tmpdir):
+    db = create_test_database(tmpdir)
+    assert db.find_movies(languages='English') == [1234, 49141]
+    assert db.find_movies(languages=['English', 'French']) == [1234]
+    assert db.find_movies(languages='English', director=15) == [49141]
+    db.set_movie({'crit_id': 49141, 'languages': ['French'], 'genres': ['Thriller']})
+    assert db.find_movies(languages='French') == [1234, 49141]
+    assert db.find_movies(languages='French', genres='Thriller') == [49141]
+    assert db.find_movies(languages='English') == [1234]
+
+
+def test_query(tmpdir):
+    db = create_test_database(tmpdir)
+    db.save_movies([{'crit_id': 12345, 'crit_url': 'blahblah', 'title': 'Pulp Fiction', 'date_added': arrow.now(),
+                     'year': 1994, 'netflix_id': 123, 'my_ratings': {'tijl': {'pred_score': 85.0}}},
+                    {'crit_id': 1234, 'netflix_id': 456, 'my_ratings': {'tijl': {'pred_score': 70.0}}},
+                    {'crit_id': 49141, 'my_ratings': {'tijl': {'pred_score': 90.0}}}], verbose=False)
+    best = db.query(order_by="my_ratings['tijl']['pred_score']", k=2)
+    assert [movie.crit_id for movie in best] == [49141, 12345]
+    best = db.query(where=lambda m: m.netflix_id is not None, order_by="my_ratings['tijl']['pred_score']")
+    assert [movie.crit_id for movie in best] == [12345, 1234]
+    assert [movie.crit_id for movie in db.query(year=(1995, None))] == [1234, 49141]
+    assert [movie.crit_id for movie in db.query(year=(1990, 2005), languages='English')] == [1234]
+    assert [movie.crit_id for movie in db.query(title='Inception')] == [49141]
+    assert [movie.crit_id for movie in db.query(order_by='year', ascending=True, k=1)] == [12345]
+
+
+def test_column_store(tmpdir):
+    db = create_test_database(tmpdir)
+    assert list(db.column_store.crit_ids) == [1234, 49141]
+    assert list(db.column_store.column('year')) == [1999, 2010]
+    db.set_movie({'crit_id': 12345, 'crit_url': 'blahblah', 'title': 'Pulp Fiction', 'date_added': arrow.now(),
+                  'year': 1994})
+    db.set_movie({'crit_id': 1234, 'crit_popularity': 8})
+    assert list(db.column_store.column('year')) == [1999, 2010, 1994]
+    assert list(db.column_store.values('crit_popularity')) == [8, 1]
@@ -1,18 +1,28 @@
 import datetime as dt
+import threading
 import time
 
 import arrow
+import numpy as np
 import pytest
-from mock import patch
 
 from qmdb.database.database import MySQLDatabase
-from qmdb.interfaces.criticker import CritickerScraper
-from qmdb.interfaces.omdb import OMDBScraper
+from qmdb.database.sqlite import SQLiteDatabase
 from qmdb.interfaces.updater import Updater
 from qmdb.test.test_utils import create_test_tables, remove_test_tables
 from qmdb.utils.utils import no_internet
 
 
+@pytest.fixture
+def db(tmpdir):
+    """
+    A SQLite database with the movies of the 'updates' variant of the test tables
+    """
+    path = str(tmpdir.join('qmdb_test.db'))
+    create_test_tables(variant='updates', db=SQLiteDatabase(path, from_scratch=True))
+    return SQLiteDatabase(path)
+
+
 def test_calculate_frequency_score():
     updater = Updater()
     score = updater.calculate_period_score(11, {'a_parameter': 0.91866, 'b_parameter': 0.35824})
@@ -53,23 +63,17 @@ def test_calculate_next_update():
     assert next_update.timestamp < arrow.get(dt.datetime(2018, 1, 9)).timestamp
 
 
-@patch.object(CritickerScraper, 'get_movie_info',
-              lambda x, y: {'imdbid': 12345, 'crit_updated': arrow.get('2019-01-01 00:00:00+01:00')})
-@patch.object(OMDBScraper, 'imdbid_to_rturl', lambda x, y: 'http://www.rottentomatoes.com/m/the-matrix/')
-@patch.object(arrow, 'now', lambda: arrow.get('2019-01-01 00:00:00+01:00'))
-def test_get_update_sequence():
-    create_test_tables(variant='updates')
-    db = MySQLDatabase(schema='qmdb_test', env='tst')
-    updater = Updater()
-    updater.get_movies_stats(db)
-    seq = updater.get_all_next_updates(db, weibull_lambda=10000)
-    assert len(seq) == 48
-    for e in seq:
-        assert isinstance(e, dict)
-    assert len([e for e in seq if e['source'] == 'criticker']) == 5
-    assert len([e for e in seq if e['source'] == 'omdb']) == 3
-    assert len([e for e in seq if e['source'] == 'ptp']) == 5
-    remove_test_tables(db)
+def test_build_queues(db):
+    updater = Updater(seed=1)
+    updater.build_queues(db, weibull_lambda=10000)
+    until = arrow.get('2019-01-01 00:00:00+01:00').float_timestamp
+    due = [source for queue in updater.queues.values() for t, _, source in queue if t <= until]
+    assert len(due) == 48
+    assert due.count('criticker') == 5
+    assert due.count('omdb') == 3
+    assert due.count('ptp') == 5
+    assert all([updater.get_source_group(source) == group
+                for group, queue in updater.queues.items() for _, _, source in queue])
 
 
 @pytest.mark.skipif(no_internet(), reason='There is no internet connection.')
@@ -85,25 +89,132 @@ def test_update_source():
     remove_test_tables(db)
 
 
-d = [{'source': 'criticker', 'crit_id': 1234,  'next_update': arrow.get('2018-01-01 01:40:00'), 'update_period': 1.0},
-     {'source': 'omdb',      'crit_id': 1234,  'next_update': arrow.get('2018-01-01 08:24:00'), 'update_period': 5.0},
-     {'source': 'criticker', 'crit_id': 49141, 'next_update': arrow.get('2018-01-01 13:26:00'), 'update_period': 8.0},
-     {'source': 'omdb',      'crit_id': 49141, 'next_update': arrow.get('2018-01-03 19:11:00'), 'update_period': 40.0},
-     {'source': 'criticker', 'crit_id': 2345,  'next_update': arrow.get('2018-01-05 11:30:00'), 'update_period': 64.0},
-     {'source': 'criticker', 'crit_id': 4567,  'next_update': arrow.get('2018-01-08 00:00:00'), 'update_period': 1.0},
-     {'source': 'omdb',      'crit_id': 2345,  'next_update': arrow.get('2018-01-23 09:34:00'), 'update_period': 320.0},
-     {'source': 'omdb',      'crit_id': 4567,  'next_update': arrow.get('2018-02-04 23:56:00'), 'update_period': 5.0},
-     {'source': 'criticker', 'crit_id': 5678,  'next_update': arrow.get('2018-02-26 00:06:00'), 'update_period': 8.0},
-     {'source': 'omdb',      'crit_id': 5678,  'next_update': arrow.get('2018-10-08 00:30:00'), 'update_period': 40.0}]
+def test_update_movies(db, mocker):
+    mocker.patch.object(time, 'sleep', lambda x: None)
+    # None of the sources give anything
+    mocker.patch.object(Updater, 'update_source', lambda x, y, z: None)
+    mocker.spy(Updater, 'update_source')
+    updater = Updater(seed=1)
+    updater.build_queues(db, weibull_lambda=10000)
+    start = time.time()
+    due = {(crit_id, source) for queue in updater.queues.values() for t, crit_id, source in queue if t <= start}
+    assert len(due) > 0
+    updater.update_movies(db, weibull_lambda=10000)
+    updated = [(call[0][2]['crit_id'], call[0][2]['source']) for call in Updater.update_source.call_args_list]
+    assert sorted(updated) == sorted(due)
+    # The sources that couldn't be refreshed are tried again later instead of right away
+    assert sum([len(queue) for queue in updater.queues.values()]) == 5*10 + 1
+    for queue in updater.queues.values():
+        for t, crit_id, source in queue:
+            if (crit_id, source) in due:
+                assert t >= start + updater.retry_delay
 
 
-def test_update_movies(mocker):
-    mocker.patch.object(Updater, 'get_all_next_updates', lambda x, y, **kwargs: d)
+def test_update_movies_reschedules(db, mocker):
     mocker.patch.object(time, 'sleep', lambda x: None)
-    mocker.patch.object(Updater, 'update_source', lambda x, y, z: None)
-    create_test_tables(variant='updates')
-    db = MySQLDatabase(schema='qmdb_test', env='tst')
+
+    def update_source(self, db, source_to_update):
+        movie_info = {'crit_id': source_to_update['crit_id'], source_to_update['source'] + '_updated': arrow.now()}
+        if source_to_update['crit_id'] == 49141:
+            movie_info['imdbid'] = 1375666
+        db.set_movie(movie_info)
+    mocker.patch.object(Updater, 'update_source', update_source)
+    mocker.spy(Updater, 'update_source')
+    mocker.spy(Updater, 'calculate_all_next_updates')
     updater = Updater()
+    updater.update_movies(db, n=3, weibull_lambda=10000)
+    assert Updater.update_source.call_count == 3
+    assert sum([len(queue) for queue in updater.queues.values()]) == 5*10 + 1
     updater.update_movies(db, weibull_lambda=10000)
-    # TODO: change this unit test to test get_update_sequence, assert timings of next updates
-    remove_test_tables(db)
+    assert Updater.calculate_all_next_updates.call_count == 1
+    # Once Inception has an IMDb id, its other sources are scheduled as well, and done in the next pass
+    assert sum([len(queue) for queue in updater.queues.values()]) == 6*10
+    updater.update_movies(db, weibull_lambda=10000)
+    assert min([queue[0][0] for queue in updater.queues.values()]) > time.time()
+    n_updates = Updater.update_source.call_count
+    updater.update_movies(db, weibull_lambda=10000)
+    assert Updater.update_source.call_count == n_updates
+
+
+def test_calculate_all_next_updates(db):
+    updater = Updater(seed=42)
+    updater.get_movies_stats(db)
+    updates = updater.calculate_all_next_updates(db, weibull_lambda=1.5)
+    assert len(updates['crit_id']) == 5*10 + 1
+    assert list(updates['source']).count('criticker') == 6
+    other_updater = Updater(seed=42)
+    other_updater.get_movies_stats(db)
+    other_updates = other_updater.calculate_all_next_updates(db, weibull_lambda=1.5)
+    assert np.array_equal(updates['next_update'], other_updates['next_update'])
+    # Without jitter, the batch computation gives the same schedule as the one per movie
+    updates = updater.calculate_all_next_updates(db, weibull_lambda=10000)
+    for crit_id, source, next_update, period in zip(updates['crit_id'], updates['source'],
+                                                    updates['next_update'], updates['update_period']):
+        u = updater.calculate_next_updates(db.movies[crit_id], weibull_lambda=10000, sources=[source])[0]
+        assert next_update == pytest.approx(u['next_update'].float_timestamp, abs=24*3600)
+        assert period == pytest.approx(u['actual_update_period'])
+
+
+def test_schedule_is_stored(db, mocker):
+    updater = Updater(seed=1)
+    updater.build_queues(db)
+    assert len(db.load_schedule()) == 5*10 + 1
+    # After a restart, the stored schedule is used instead of a new one
+    other_updater = Updater(seed=2)
+    other_updater.build_queues(db)
+    for group, queue in updater.queues.items():
+        other_queue = other_updater.queues[group]
+        assert [(crit_id, source) for _, crit_id, source in sorted(queue)] == \
+            [(crit_id, source) for _, crit_id, source in sorted(other_queue)]
+        assert [t for t, _, _ in sorted(queue)] == pytest.approx([t for t, _, _ in sorted(other_queue)], abs=1e-3)
+    # Only the updates that are missing from the stored schedule are calculated
+    with db.connection():
+        db.c.execute("delete from schedule where crit_id = %s and source = %s", [1234, 'omdb'])
+    mocker.spy(Updater, 'calculate_all_next_updates')
+    other_updater.build_queues(db)
+    updates = Updater.calculate_all_next_updates.spy_return
+    assert list(zip(updates['crit_id'], updates['source'])) == [(1234, 'omdb')]
+    assert len(db.load_schedule()) == 5*10 + 1
+
+
+def test_update_movies_concurrently(db, mocker):
+    mocker.patch.object(time, 'sleep', lambda x: None)
+    threads = set()
+
+    def update_source(self, db, source_to_update):
+        threads.add(threading.current_thread().name)
+        db.set_movie({'crit_id': source_to_update['crit_id'], source_to_update['source'] + '_updated': arrow.now()})
+    mocker.patch.object(Updater, 'update_source', update_source)
+    mocker.spy(Updater, 'update_source')
+    updater = Updater(seed=1)
+    updater.build_queues(db, weibull_lambda=10000)
+    due = {(crit_id, source) for queue in updater.queues.values() for t, crit_id, source in queue
+           if t <= time.time()}
+    updater.update_movies_concurrently(db, duration=0, weibull_lambda=10000)
+    assert threads == {'updater-criticker', 'updater-omdb', 'updater-imdb', 'updater-ptp'}
+    assert updater.busy_crit_ids == set()
+    # A source of a movie that another worker was refreshing is postponed, but nothing gets lost
+    assert sum([len(queue) for queue in updater.queues.values()]) == 5*10 + 1
+    updated = [(call[0][2]['crit_id'], call[0][2]['source']) for call in Updater.update_source.call_args_list]
+    assert len(updated) == len(set(updated))
+    postponed = [(crit_id, source) for queue in updater.queues.values() for t, crit_id, source in queue
+                 if t < time.time() + 120]
+    assert set(updated + postponed) == due
+
+
+def test_failed_updates_are_rescheduled(db, mocker):
+    mocker.patch.object(time, 'sleep', lambda x: None)
+
+    def update_source(self, db, source_to_update):
+        raise ConnectionError
+    mocker.patch.object(Updater, 'update_source', update_source)
+    updater = Updater(seed=1)
+    updater.build_queues(db, weibull_lambda=10000)
+    start = time.time()
+    updater.update_movies_concurrently(db, duration=0, weibull_lambda=10000)
+    assert sum([len(queue) for queue in updater.queues.values()]) == 5*10 + 1
+    # The failed updates are tried again later, instead of right away
+    assert min([queue[0][0] for queue in updater.queues.values() if len(queue) > 0]) > start
+    with pytest.raises(ConnectionError):
+        updater.update_movies(db, n=1, weibull_lambda=10000)
+    assert sum([len(queue) for queue in updater.queues.values()]) == 5*10 + 1
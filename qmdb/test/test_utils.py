@@ -4,8 +4,13 @@ import mock
 import pickle
 
 
-def create_test_tables(variant='normal', env='tst'):
-    db = MySQLDatabase(schema='qmdb_test', from_scratch=True, env=env)
+def create_test_tables(variant='normal', env='tst', db=None):
+    if db is None:
+        db = MySQLDatabase(schema='qmdb_test', from_scratch=True, env=env)
+    else:
+        db.connect()
+        db.initialize()
+        db.close()
     if variant == 'normal':
         movies_records = [{'crit_id': 1234,
                            'crit_popularity': 10,
@@ -141,11 +146,12 @@ def create_test_tables(variant='normal', env='tst'):
         db.update_single_record('persons', rec)
     for rec in netflix_genres_records:
         db.update_single_record('netflix_genres', rec)
+    return db
 
 
 def remove_test_tables(db):
     for tbl in ['countries', 'genres', 'keywords', 'languages', 'movies',
-                'persons', 'taglines', 'vote_details', 'netflix_genres']:
+                'persons', 'taglines', 'vote_details', 'netflix_genres', 'schema_version', 'schedule', 'rate_limits']:
         db.remove_table(table_name=tbl)
 
 
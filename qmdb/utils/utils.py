@@ -20,6 +20,5 @@ def no_internet():
 def create_copy_of_table(src, tgt, schema='qmdb_test'):
     db = MySQLDatabase(schema=schema)
     db.remove_table(tgt)
-    db.connect()
-    db.c.execute("create table {} as select * from {}".format(tgt, src))
-    db.close()
+    with db.connection():
+        db.c.execute("create table {} as select * from {}".format(tgt, src))